@@ -3,18 +3,29 @@
 from __future__ import annotations
 
 import os
+import atexit
 import sys
 import json
-import math
 import time
+import queue
+import threading
 import argparse
+import operator
 import logging
+import shutil
+from logging.handlers import QueueHandler, QueueListener
 import pathlib
 import datetime as dt
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from itertools import islice
+from types import MappingProxyType
+from typing import Any, Callable, DefaultDict, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 # ============================================================
@@ -27,8 +38,16 @@ STATS_TIMEOUT = 30
 WRITE_TIMEOUT = 30
 RETRY_COUNT = 3
 RETRY_BACKOFF = 1.8
+RATE_LIMIT_RETRY_COUNT = 10  # 429 повторяем отдельно и не тратим на них RETRY_COUNT
 
 DEFAULT_MAX_DISABLES_PER_RUN = 20
+
+# Параллелизм (всё упирается в HTTP к VK, GIL на сетевом I/O отпускается)
+MAX_CABINET_WORKERS = 8
+STATS_PERIOD_WORKERS = 4
+API_CHUNK_WORKERS = 8  # параллельные GET по чанкам _id__in внутри одного кабинета
+VK_MAX_INFLIGHT = 8  # одновременных запросов к VK на весь процесс (все кабинеты и пулы вместе)
+OBJECTIVES_CACHE_TTL_SEC = 3600  # objective групп почти не меняется — кэш на диске живёт час
 DEFAULT_USERS_ROOT = os.environ.get("VK_CHECKER_USERS_ROOT", "/opt/vk_checker/v4/users")
 
 # ============================================================
@@ -39,17 +58,57 @@ LOG_DIR = pathlib.Path("/opt/vk_checker/v4/logs")
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOG_FILE = LOG_DIR / "vk_checker_v4.log"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(LOG_FILE, encoding="utf-8"),
-    ],
-)
+# Пишут в stdout/файл не рабочие потоки, а отдельный поток QueueListener:
+# logger.info(...) в горячих циклах — это только queue.put.
+_log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(_log_formatter)
+_log_file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+_log_file_handler.setFormatter(_log_formatter)
+
+class _CabinetPrefixFormatter(logging.Formatter):
+    """
+    %(message)s + префикс [CAB <id>] на каждой строке, если запись пришла от CabinetLogAdapter.
+    Префикс добавляется к уже отформатированному сообщению — % в id не трогает подстановку args.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        cabinet_id = getattr(record, "cabinet_id", None)
+        if cabinet_id is None:
+            return text
+        prefix = f"[CAB {cabinet_id}] "
+        return prefix + text.replace("\n", "\n" + prefix)
+
+
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_queue_handler = QueueHandler(_log_queue)
+# сообщение без asctime/levelname — их добавят обработчики слушателя
+_log_queue_handler.setFormatter(_CabinetPrefixFormatter("%(message)s"))
+
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+_log_listener = QueueListener(_log_queue, _log_stream_handler, _log_file_handler, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logger = logging.getLogger("vk_checker_v4")
 
 
+class CabinetLogAdapter(logging.LoggerAdapter):
+    """
+    Префикс [CAB <id>] для строк одного кабинета: кабинеты обрабатываются параллельно,
+    и без него строки баннеров разных кабинетов в логе не различить.
+    Id кабинета уходит в запись через extra, сам префикс добавляет _CabinetPrefixFormatter.
+    """
+
+    def __init__(self, base: logging.Logger, cabinet_id: str):
+        super().__init__(base, {"cabinet_id": cabinet_id})
+
+
+# логгер процесса или логгер кабинета с префиксом
+Log = Union[logging.Logger, logging.LoggerAdapter]
+
+
 # ============================================================
 # Утилиты
 # ============================================================
@@ -82,11 +141,29 @@ def load_user_env(users_root: str, tg_id: Optional[str]) -> None:
 def ensure_dir(p: pathlib.Path) -> None:
     p.mkdir(parents=True, exist_ok=True)
 
-def chunked(lst: List[int], size: int = 200) -> List[List[int]]:
-    for i in range(0, len(lst), size):
-        yield lst[i:i + size]
+
+def atomic_write_text(path: pathlib.Path, text: str) -> None:
+    """
+    Пишем во временный файл рядом и подменяем через os.replace: при падении посреди записи
+    остаётся старый файл целиком, а не обрезанный. Один write на файл; fsync не делаем.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(text.encode("utf-8"))
+    os.replace(tmp, path)
+
+def chunked(items: Iterable[int], size: int = 200) -> Iterator[List[int]]:
+    # генератор: срезы исходного списка не создаются, подойдёт любой iterable
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
 
 def safe_float(x: Any, default: float = 0.0) -> float:
+    # быстрый путь без try для чисел из JSON (самый частый случай)
+    t = type(x)
+    if t is float:
+        return x
+    if t is int:
+        return float(x)
     try:
         if x is None:
             return default
@@ -103,70 +180,184 @@ def fmt_int(x: Any, default: int = 0) -> str:
     except Exception:
         return str(default)
 
+@lru_cache(maxsize=1)
+def _now_str_bucket(second: int) -> str:
+    return (dt.datetime.fromtimestamp(second) + dt.timedelta(hours=4)).isoformat(sep=" ", timespec="seconds")
+
+
 def now_str() -> str:
-    return (dt.datetime.now() + dt.timedelta(hours=4)).strftime("%Y-%m-%d %H:%M:%S")
+    # строка с точностью до секунды — в пределах одной секунды отдаём готовую
+    return _now_str_bucket(int(time.time()))
+
+
+def parse_ymd_hms(s: str) -> dt.datetime:
+    """
+    "YYYY-mm-dd HH:MM:SS" -> naive datetime. fromisoformat (на C) в разы быстрее strptime;
+    длину проверяем, чтобы строки с таймзоной/долями секунды шли старым путём (как раньше — ValueError/strptime).
+    """
+    if len(s) == 19 and s[10] == " ":
+        return dt.datetime.fromisoformat(s)
+    return dt.datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
+
+
+# json.dumps с нестандартными аргументами на каждый вызов собирает новый JSONEncoder —
+# кодировщики с нашими настройками создаём один раз (encode() потокобезопасен).
+# ensure_ascii=False: кириллица идёт как UTF-8 (2 байта), а не \uXXXX (6 байт)
+_JSON_COMPACT = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+_JSON_LINE = json.JSONEncoder(ensure_ascii=False)  # history (JSONL), objectives_cache
+_JSON_PRETTY = json.JSONEncoder(ensure_ascii=False, indent=2)  # disabled/enabled, notify_state
+
+
+def json_dumps_bytes(obj: Any) -> bytes:
+    return _JSON_COMPACT.encode(obj).encode("utf-8")
+
+
+_JSON_CONTENT_TYPE = {"Content-Type": "application/json"}
+
+
+def make_http_session() -> requests.Session:
+    """
+    Session с пулом keep-alive соединений: пул не меньше числа потоков,
+    которые одновременно ходят через одну сессию (кабинеты / чанки / периоды).
+    Повторы делает req_with_retry, поэтому у адаптера max_retries=0.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # ответы VK (списки баннеров, статистика) приходят сжатыми
+    session.headers.update({"Accept-Encoding": "gzip"})
+    return session
+
+
+# общая сессия для вызовов req_with_retry без своей session
+HTTP_SESSION = make_http_session()
+
+# Пулы кабинетов, страниц и чанков вложены друг в друга — без общего лимита в полёте
+# оказываются сотни запросов и VK отвечает 429. Слот держим только на время самого запроса.
+_VK_INFLIGHT = threading.BoundedSemaphore(VK_MAX_INFLIGHT)
 
 
 def req_with_retry(
     method: str,
     url: str,
-    headers: Dict[str, str],
+    headers: Mapping[str, str],
     params: Optional[Dict[str, Any]] = None,
-    json_body: Optional[Dict[str, Any]] = None,
+    json_body: Any = None,
     timeout: int = 30,
+    session: Optional[requests.Session] = None,
+    content: Optional[bytes] = None,
+    log: Log = logger,
+    retry_client_errors: bool = True,
 ) -> requests.Response:
-    last_exc: Optional[Exception] = None
-    for attempt in range(1, RETRY_COUNT + 1):
+    """
+    retry_client_errors=False — ответ 4xx (кроме 429) возвращаем сразу, без повторов и исключения:
+    для запросов, у которых на отказ есть свой запасной путь (mass_action -> поштучно).
+    """
+    # соединения (TCP/TLS) переиспользуются между запросами
+    http = session if session is not None else HTTP_SESSION
+    if content is None and json_body is not None:
+        # тело сериализуем один раз, а не на каждой попытке (как было бы с json=)
+        content = json_dumps_bytes(json_body)
+        if "Content-Type" not in headers:
+            headers = {**headers, "Content-Type": "application/json"}
+    attempt = 0
+    throttled = 0
+    while True:
         try:
-            resp = requests.request(method, url, headers=headers, params=params, json=json_body, timeout=timeout)
+            with _VK_INFLIGHT:
+                resp = http.request(method, url, headers=headers, params=params, data=content, timeout=timeout)
 
-            if resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", "3"))
-                logger.warning(f"⚠️ VK API rate limit (429). Пауза {retry_after}s перед повтором...")
+            # rate limit — не сбой запроса: ждём и повторяем, попытки RETRY_COUNT не расходуем.
+            # Когда и отдельный лимит 429 исчерпан, ответ идёт в обычную обработку ошибок ниже.
+            if resp.status_code == 429 and throttled < RATE_LIMIT_RETRY_COUNT:
+                throttled += 1
+                try:
+                    retry_after = int(resp.headers.get("Retry-After", "3"))
+                except ValueError:
+                    retry_after = 3
+                log.warning(f"⚠️ VK API rate limit (429). Пауза {retry_after}s перед повтором...")
                 time.sleep(retry_after)
                 continue
 
+            if not retry_client_errors and 400 <= resp.status_code < 500:
+                return resp
             if resp.status_code >= 400:
                 raise requests.HTTPError(f"{resp.status_code} {resp.text}")
 
             return resp
         except Exception as e:
-            last_exc = e
+            attempt += 1
+            if attempt >= RETRY_COUNT:
+                raise
             sleep_for = RETRY_BACKOFF ** (attempt - 1)
-            logger.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT} не удалась: {e}. Повтор через {sleep_for:.1f}s")
+            log.warning(f"{method} {url} попытка {attempt}/{RETRY_COUNT} не удалась: {e}. Повтор через {sleep_for:.1f}s")
             time.sleep(sleep_for)
 
-    assert last_exc is not None
-    raise last_exc
-
 # Human reason ================================================
 
+_OP_HUMAN: Dict[str, str] = {
+    "LT": "<",
+    "LTE": "≤",
+    "EQ": "=",
+    "GTE": "≥",
+    "GT": ">",
+}
+
+_METRIC_HUMAN: Dict[str, str] = {
+    "SPENT": "Расход",
+    "CLICKS": "Клики",
+    "RESULTS": "Результаты",
+    "CLICK_COST": "Цена клика",
+    "RESULT_COST": "Цена результата",
+    "CPC": "Цена клика",
+    "CPA": "Цена результата",
+}
+
+
+@lru_cache(maxsize=32)
 def op_to_human(op: str) -> str:
     op = (op or "").upper()
-    return {
-        "LT": "<",
-        "LTE": "≤",
-        "EQ": "=",
-        "GTE": "≥",
-        "GT": ">",
-    }.get(op, op)
+    return _OP_HUMAN.get(op, op)
 
 
+@lru_cache(maxsize=32)
 def metric_to_human(metric: str) -> str:
     metric = (metric or "").upper()
-    return {
-        "SPENT": "Расход",
-        "CLICKS": "Клики",
-        "RESULTS": "Результаты",
-        "CLICK_COST": "Цена клика",
-        "RESULT_COST": "Цена результата",
-        "CPC": "Цена клика",
-        "CPA": "Цена результата",
-    }.get(metric, metric)
+    return _METRIC_HUMAN.get(metric, metric)
 
 # ============================================================
 # Telegram
 # ============================================================
+# Отправка в TG идёт фоновым потоком: прогон не ждёт ответа Telegram (до 20s на сообщение).
+# В конце main() очередь дожидается через tg_flush().
+_tg_queue: "queue.Queue[Tuple[str, bytes]]" = queue.Queue()
+_tg_worker: Optional[threading.Thread] = None
+_tg_worker_lock = threading.Lock()
+
+
+def _tg_worker_loop() -> None:
+    session = make_http_session()
+    while True:
+        url, body = _tg_queue.get()
+        try:
+            r = session.post(url, data=body, headers=_JSON_CONTENT_TYPE, timeout=20)
+            if r.status_code != 200:
+                logger.error(f"TG notify failed: {r.status_code} {r.text}")
+        except Exception as e:
+            logger.error(f"TG notify exception: {e}")
+        finally:
+            _tg_queue.task_done()
+
+
+def _ensure_tg_worker() -> None:
+    global _tg_worker
+    with _tg_worker_lock:
+        if _tg_worker is None or not _tg_worker.is_alive():
+            _tg_worker = threading.Thread(target=_tg_worker_loop, name="tg-notify", daemon=True)
+            _tg_worker.start()
+
+
 def tg_notify(bot_token: str, chat_id: str, text: str, dry_run: bool) -> None:
     if dry_run:
         logger.info("🧪 [DRY RUN] TG уведомление не отправлено (тестовый режим)")
@@ -179,47 +370,115 @@ def tg_notify(bot_token: str, chat_id: str, text: str, dry_run: bool) -> None:
         "parse_mode": "HTML",
         "disable_web_page_preview": True,
     }
-    try:
-        r = requests.post(url, json=payload, timeout=20)
-        if r.status_code != 200:
-            logger.error(f"TG notify failed: {r.status_code} {r.text}")
-    except Exception as e:
-        logger.error(f"TG notify exception: {e}")
+    _ensure_tg_worker()
+    _tg_queue.put((url, json_dumps_bytes(payload)))
+
+
+def tg_flush() -> None:
+    """Ждём, пока фоновый поток отправит всё, что поставлено в очередь."""
+    if _tg_worker is not None:
+        _tg_queue.join()
 
 
 # ============================================================
 # Income loader
 # ============================================================
+@lru_cache(maxsize=64)
+def _period_keys(ptype: str, n: int, today_ordinal: int) -> Tuple[str, ...]:
+    """Ключи "dd.mm.YYYY" для периода — strftime на каждый день считается один раз на (период, дату)."""
+    today = dt.date.fromordinal(today_ordinal)
+    if ptype == "TODAY":
+        return (today.strftime("%d.%m.%Y"),)
+
+    if ptype == "YESTERDAY":
+        return ((today - dt.timedelta(days=1)).strftime("%d.%m.%Y"),)
+
+    if ptype == "LAST_N_DAYS":
+        return tuple((today - dt.timedelta(days=i)).strftime("%d.%m.%Y") for i in range(max(1, n)))
+
+    return ()
+
+
 @dataclass
 class IncomeStore:
     total: Dict[str, float]
     by_day: Dict[str, Dict[str, float]]  # "dd.mm.YYYY" -> {banner_id: income}
+    # ключи дней периода -> {banner_id: доход за период}; общий для всех кабинетов пользователя
+    _period_cache: Dict[Tuple[str, ...], Dict[str, float]] = field(default_factory=dict, repr=False)
 
-    def income_for_period(self, banner_id: int, period: Dict[str, Any]) -> float:
-        bid = str(banner_id)
+    def _day_keys(self, period: Dict[str, Any], today: Optional[dt.date] = None) -> Optional[Tuple[str, ...]]:
+        """Ключи by_day для периода; None => ALL_TIME (берём total)."""
         ptype = (period or {}).get("type", "ALL_TIME")
         if ptype == "ALL_TIME":
-            return safe_float(self.total.get(bid, 0.0))
+            return None
+        n = int((period or {}).get("n", 1) or 1) if ptype == "LAST_N_DAYS" else 0
+        return _period_keys(str(ptype), n, (today or dt.date.today()).toordinal())
 
-        today = dt.date.today()
-        if ptype == "TODAY":
-            key = today.strftime("%d.%m.%Y")
-            return safe_float(self.by_day.get(key, {}).get(bid, 0.0))
+    def period_income(self, period: Dict[str, Any], today: Optional[dt.date] = None) -> Dict[str, float]:
+        """
+        {banner_id: доход} за период. Дневные словари складываются один раз на период,
+        дальше доход баннера — один dict.get.
+        """
+        keys = self._day_keys(period, today)
+        if keys is None:
+            return self.total
+
+        acc = self._period_cache.get(keys)
+        if acc is None:
+            day_maps = [m for m in (self.by_day.get(key) for key in keys) if m]
+            if len(day_maps) == 1:
+                # один день (TODAY / YESTERDAY / дыры в файле) — складывать нечего, отдаём дневной словарь как есть
+                acc = day_maps[0]
+            else:
+                # первый день копируется целиком (на C), в Python-цикле складываем только остальные
+                acc = dict(day_maps[0]) if day_maps else {}
+                for m in day_maps[1:]:
+                    for bid, val in m.items():
+                        acc[bid] = acc.get(bid, 0.0) + val
+            self._period_cache[keys] = acc
+        return acc
+
+    def income_for_period_bulk(
+        self, banner_ids: List[int], period: Dict[str, Any], today: Optional[dt.date] = None
+    ) -> Dict[int, float]:
+        """Доход за период сразу для всех баннеров: banner_id -> income."""
+        m = self.period_income(period, today)
+        return {banner_id: safe_float(m.get(str(banner_id), 0.0)) for banner_id in banner_ids}
+
+
+# (type, n) -> маленький int id периода; общий на процесс, id никогда не меняются
+_PERIOD_IDS: Dict[Tuple[Any, Any], int] = {}
+_PERIOD_IDS_LOCK = threading.Lock()
 
-        if ptype == "YESTERDAY":
-            key = (today - dt.timedelta(days=1)).strftime("%d.%m.%Y")
-            return safe_float(self.by_day.get(key, {}).get(bid, 0.0))
 
-        if ptype == "LAST_N_DAYS":
-            n = int((period or {}).get("n", 1) or 1)
-            n = max(1, n)
-            s = 0.0
-            for i in range(n):
-                key = (today - dt.timedelta(days=i)).strftime("%d.%m.%Y")
-                s += safe_float(self.by_day.get(key, {}).get(bid, 0.0))
-            return s
+def period_id(period: Dict[str, Any]) -> int:
+    """
+    Ключ stats_by_period. Период идентифицируют только type и n — так же,
+    как их собирает collect_periods_from_filters (лишние поля / отсутствие n ключ не меняют).
+    """
+    period = period or {}
+    key = (period.get("type"), period.get("n"))
+    pid = _PERIOD_IDS.get(key)
+    if pid is None:
+        # новые периоды появляются только при разборе фильтров — лок берём лишь на промахе
+        with _PERIOD_IDS_LOCK:
+            pid = _PERIOD_IDS.setdefault(key, len(_PERIOD_IDS))
+    return pid
 
-        return 0.0
+
+ALL_TIME_PERIOD: Dict[str, Any] = {"type": "ALL_TIME"}
+ALL_TIME_ID: int = period_id(ALL_TIME_PERIOD)
+
+
+def income_period_key(period: Dict[str, Any]) -> Tuple[str, int]:
+    """Ключ income_by_period: периоды, дающие одинаковый доход, схлопываются в один ключ."""
+    ptype = (period or {}).get("type", "ALL_TIME")
+    if ptype == "LAST_N_DAYS":
+        return ptype, max(1, int((period or {}).get("n", 1) or 1))
+    return ptype, 0
+
+
+INCOME_ALL_TIME_KEY: Tuple[str, int] = ("ALL_TIME", 0)
 
 
 def load_income_store(path: str) -> IncomeStore:
@@ -228,10 +487,9 @@ def load_income_store(path: str) -> IncomeStore:
         return IncomeStore(total={}, by_day={})
 
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-        total: Dict[str, float] = {}
-        by_day: Dict[str, Dict[str, float]] = {}
+        raw = json.loads(pathlib.Path(path).read_bytes())
+        total: DefaultDict[str, float] = defaultdict(float)
+        by_day: Dict[str, DefaultDict[str, float]] = {}
 
         if not isinstance(raw, list):
             logger.warning(f"⚠️ Файл доходов {path}: ожидался список, получили {type(raw).__name__}")
@@ -243,16 +501,22 @@ def load_income_store(path: str) -> IncomeStore:
             if not day_str or not isinstance(data, dict):
                 continue
 
-            day_map: Dict[str, float] = by_day.get(day_str, {})
+            day_map = by_day.get(day_str)
+            if day_map is None:
+                day_map = by_day[day_str] = defaultdict(float)
+            # ключи JSON-объекта уже строки — str(bid) не нужен
             for bid, val in data.items():
-                try:
+                if isinstance(val, (int, float)):
                     fval = float(val)
-                except Exception:
+                elif isinstance(val, str):
+                    try:
+                        fval = float(val)
+                    except ValueError:
+                        continue
+                else:
                     continue
-                total[str(bid)] = total.get(str(bid), 0.0) + fval
-                day_map[str(bid)] = day_map.get(str(bid), 0.0) + fval
-
-            by_day[day_str] = day_map
+                total[bid] += fval
+                day_map[bid] += fval
 
         logger.info(f"✅ Загружены доходы: total_banners={len(total)}, days={len(by_day)} из {path}")
         return IncomeStore(total=total, by_day=by_day)
@@ -262,57 +526,197 @@ def load_income_store(path: str) -> IncomeStore:
         return IncomeStore(total={}, by_day={})
 
 
+@lru_cache(maxsize=32)
+def _load_income_cached(path: str, mtime: float) -> IncomeStore:
+    return load_income_store(path)
+
+
+def load_income_store_cached(path: str) -> IncomeStore:
+    """
+    load_income_store с кэшем по (path, mtime): пользователи с общим файлом доходов
+    разбирают его один раз за запуск; изменённый файл перечитывается.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return load_income_store(path)
+    return _load_income_cached(path, mtime)
+
+
 # ============================================================
 # VK ADS API
 # ============================================================
+# тела POST /banners/{id}.json постоянные — сериализуем один раз
+_STATUS_BODIES: Dict[str, bytes] = {st: json_dumps_bytes({"status": st}) for st in ("blocked", "active")}
+
+# ключи content, по которым ищется превью баннера (get_banner_url)
+_VIDEO_PREFERRED_KEY = "video_portrait_9_16_30s"
+_VIDEO_PREFIX = "video_portrait_"
+_IMAGE_PREFIX = "image_"
+
+
+def _parse_stats_items(items: List[Dict[str, Any]]) -> Dict[int, Dict[str, float]]:
+    """Общий разбор items из statistics/banners/{summary,day}.json -> {banner_id: метрики}."""
+    result: Dict[int, Dict[str, float]] = {}
+    _sf = safe_float  # локальные имена — в цикле по тысячам строк
+    for it in items:
+        try:
+            _id = int(it.get("id"))
+        except Exception:
+            continue
+
+        # только читаем — копия base не нужна
+        base = (it.get("total") or {}).get("base") or {}
+        vk = base.get("vk") or {}
+        get = base.get
+
+        result[_id] = {
+            "spent": _sf(get("spent", 0)),
+            "cpc": _sf(get("cpc", 0)),
+            "clicks": _sf(get("clicks", get("clicks_count", 0))),
+            "goals": _sf(vk.get("goals", 0)),
+            "vk.cpa": _sf(vk.get("cpa", 0)),
+        }
+    return result
+
+
+def _mass_action_applied(resp: requests.Response, status: str) -> set[int]:
+    """
+    id из ответа 200 mass_action, для которых VK явно подтвердил новый статус:
+    элементы [{"id", "status"?, "error"?}] в теле (списком или в items). Нет разбора — пустое множество.
+    """
+    try:
+        data = json.loads(resp.content)
+    except Exception:
+        return set()
+    items = data if isinstance(data, list) else (data.get("items") if isinstance(data, dict) else None)
+    if not isinstance(items, list):
+        return set()
+    applied: set[int] = set()
+    for it in items:
+        if not isinstance(it, dict) or it.get("error") or it.get("errors"):
+            continue
+        if it.get("status", status) != status:
+            continue
+        try:
+            applied.add(int(it.get("id")))
+        except Exception:
+            continue
+    return applied
+
+
 class VkAdsApi:
-    def __init__(self, token: str, base_url: str = BASE_URL, dry_run: bool = False):
+    def __init__(
+        self,
+        token: str,
+        base_url: str = BASE_URL,
+        dry_run: bool = False,
+        objectives_cache_path: Optional[pathlib.Path] = None,
+        log: Log = logger,
+    ):
         self.base_url = base_url.rstrip("/")
+        self.log = log
         self.token = token
         self.dry_run = dry_run
-        self.headers = {
+        # заголовки только читаются — MappingProxyType защищает от случайной правки
+        self.headers = MappingProxyType({
             "Authorization": f"Bearer {self.token}",
             "Accept": "application/json",
-        }
+        })
+        self._json_headers = MappingProxyType({**self.headers, "Content-Type": "application/json"})
+        # URL эндпоинтов собираем один раз
+        api_root = f"{self.base_url}/api/v2"
+        self._banners_url = f"{api_root}/banners.json"
+        self._banner_by_id_url_fmt = api_root + "/banners/{id}.json"
+        self._mass_action_url = f"{api_root}/banners/mass_action.json"
+        self._ad_groups_url = f"{api_root}/ad_groups.json"
+        self._ad_plans_url = f"{api_root}/ad_plans.json"
+        self._stats_summary_url = f"{api_root}/statistics/banners/summary.json"
+        self._stats_day_url = f"{api_root}/statistics/banners/day.json"
         self.banner_info_cache: Dict[int, Dict[str, Any]] = {}
         self.banner_objective_cache: Dict[int, str] = {}  # banner_id -> objective
+        # group_id -> (objective, ts) с диска; None => без дискового кэша
+        self.objectives_cache_path = objectives_cache_path
+        self.group_objective_cache: Dict[int, Tuple[str, float]] = (
+            load_objectives_cache(objectives_cache_path) if objectives_cache_path is not None else {}
+        )
+        # одна сессия на кабинет: keep-alive между всеми запросами (в т.ч. из потоков)
+        self.session = make_http_session()
+
+    def _get_chunks(
+        self,
+        url: str,
+        chunks: List[List[int]],
+        params_for: Callable[[List[int]], Dict[str, Any]],
+    ) -> List[Dict[str, Any]]:
+        """GET по чанкам параллельно; ответы (json) возвращаются в порядке чанков."""
+        def get_one(chunk: List[int]) -> Dict[str, Any]:
+            resp = req_with_retry(
+                "GET", url, headers=self.headers, params=params_for(chunk), timeout=STATS_TIMEOUT, session=self.session, log=self.log
+            )
+            return resp.json()
+
+        if len(chunks) <= 1:
+            return [get_one(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=min(API_CHUNK_WORKERS, len(chunks))) as ex:
+            return list(ex.map(get_one, chunks))
 
     def list_banners_by_status(self, status: str, limit: int = 1000) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/api/v2/banners.json"
-        offset = 0
-        items: List[Dict[str, Any]] = []
-        while True:
-            params = {"limit": min(limit, 200), "offset": offset, "_status": status}
-            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-            data = resp.json()
+        url = self._banners_url
+        page = min(limit, 200)
+
+        def get_page(offset: int) -> Dict[str, Any]:
+            params = {"limit": page, "offset": offset, "_status": status}
+            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT, session=self.session, log=self.log)
+            return resp.json()
+
+        # первая страница — синхронно: из неё берём count
+        data = get_page(0)
+        batch = data.get("items", []) or []
+        items: List[Dict[str, Any]] = list(batch)
+        self.log.info(f"Получено баннеров status={status}: +{len(batch)} (всего {len(items)})")
+        offset = page
+
+        # остальные страницы по count — параллельно, склеиваем в порядке offset
+        count = data.get("count")
+        if len(batch) >= page and isinstance(count, int) and count > offset:
+            offsets = list(range(offset, count, page))
+            with ThreadPoolExecutor(max_workers=min(API_CHUNK_WORKERS, len(offsets))) as ex:
+                pages = list(ex.map(get_page, offsets))
+            for data in pages:
+                batch = data.get("items", []) or []
+                items.extend(batch)
+                self.log.info(f"Получено баннеров status={status}: +{len(batch)} (всего {len(items)})")
+            offset = offsets[-1] + page
+
+        # count нет (или список успел вырасти) — дочитываем по-старому, пока страница полная
+        while len(batch) >= page:
+            data = get_page(offset)
             batch = data.get("items", []) or []
             items.extend(batch)
-            logger.info(f"Получено баннеров status={status}: +{len(batch)} (всего {len(items)})")
-            if len(batch) < params["limit"]:
-                break
-            offset += params["limit"]
+            self.log.info(f"Получено баннеров status={status}: +{len(batch)} (всего {len(items)})")
+            offset += page
         return items
 
     def fetch_banners_info(self, banner_ids: List[int], fields: str = "created,name") -> None:
         if not banner_ids:
             return
 
-        ids_to_fetch = [bid for bid in sorted(set(banner_ids)) if bid not in self.banner_info_cache]
+        # порядок не важен (всё равно режем на чанки) — просто разность множеств
+        ids_to_fetch = list(set(banner_ids) - self.banner_info_cache.keys())
         if not ids_to_fetch:
             return
 
-        url = f"{self.base_url}/api/v2/banners.json"
-        chunk_size = 200
+        url = self._banners_url
+        chunks = list(chunked(ids_to_fetch, 200))
+        responses = self._get_chunks(
+            url,
+            chunks,
+            lambda chunk: {"_id__in": ",".join(map(str, chunk)), "fields": f"{fields},id", "limit": len(chunk)},
+        )
 
-        for i in range(0, len(ids_to_fetch), chunk_size):
-            chunk = ids_to_fetch[i : i + chunk_size]
-            params = {
-                "_id__in": ",".join(map(str, chunk)),
-                "fields": f"{fields},id",
-                "limit": len(chunk),
-            }
-            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-            data = resp.json()
+        # кэш пишем только здесь, в вызывающем потоке
+        for n, data in enumerate(responses, start=1):
             items = data.get("items", []) or []
 
             for it in items:
@@ -326,18 +730,14 @@ class VkAdsApi:
                     if k in it and it.get(k) is not None:
                         info[k] = it.get(k)
 
-                created_str = info.get("created")
-                if created_str and "created_dt" not in info:
-                    try:
-                        info["created_dt"] = dt.datetime.strptime(created_str, "%Y-%m-%d %H:%M:%S")
-                    except Exception:
-                        pass
-
                 self.banner_info_cache[bid] = info
 
-            logger.info(
-                f"Загружено метаданных баннеров: +{len(items)} (chunk {i // chunk_size + 1}/{math.ceil(len(ids_to_fetch) / chunk_size)})"
-            )
+            self.log.info(f"Загружено метаданных баннеров: +{len(items)} (chunk {n}/{len(chunks)})")
+
+        # баннеры, которых VK не вернул, помечаем пустыми — иначе get_banner_name / get_banner_url
+        # будут запрашивать каждый из них поштучно
+        for bid in ids_to_fetch:
+            self.banner_info_cache.setdefault(bid, {})
 
     def get_banner_name(self, banner_id: int) -> str:
         info = self.banner_info_cache.get(banner_id)
@@ -356,20 +756,25 @@ class VkAdsApi:
         if not isinstance(content, dict):
             return ""
     
+        # Ключи видео и картинки выбираем за один проход по content:
+        #   видео — video_portrait_9_16_30s, иначе первое video_portrait_*
+        #   картинка — первое image_*
+        vkey: Optional[str] = _VIDEO_PREFERRED_KEY if _VIDEO_PREFERRED_KEY in content else None
+        ikey: Optional[str] = None
+        for k in content:
+            if not isinstance(k, str):
+                continue
+            if vkey is None and k.startswith(_VIDEO_PREFIX):
+                vkey = k
+            elif ikey is None and k.startswith(_IMAGE_PREFIX):
+                ikey = k
+            if vkey is not None and ikey is not None:
+                break
+
         # -------------------------
         # 1) Видео: video_portrait_9_16_30s -> high-first_frame -> url
         #    если нет, то любое video_portrait_* -> high-first_frame -> url
         # -------------------------
-        def pick_video_key() -> Optional[str]:
-            if "video_portrait_9_16_30s" in content:
-                return "video_portrait_9_16_30s"
-            # любое video_portrait_
-            for k in content.keys():
-                if isinstance(k, str) and k.startswith("video_portrait_"):
-                    return k
-            return None
-    
-        vkey = pick_video_key()
         if vkey:
             vobj = content.get(vkey)
             if isinstance(vobj, dict):
@@ -392,13 +797,6 @@ class VkAdsApi:
         # 2) Картинка: image_* -> variants["90x90"] иначе variants["uploaded"] -> url
         #    key может быть image_600x600, image_1080x1080 и т.п.
         # -------------------------
-        def pick_image_key() -> Optional[str]:
-            for k in content.keys():
-                if isinstance(k, str) and k.startswith("image_"):
-                    return k
-            return None
-    
-        ikey = pick_image_key()
         if ikey:
             iobj = content.get(ikey)
             if isinstance(iobj, dict):
@@ -428,138 +826,155 @@ class VkAdsApi:
     def stats_summary_banners(self, banner_ids: List[int]) -> Dict[int, Dict[str, Any]]:
         if not banner_ids:
             return {}
-        url = f"{self.base_url}/api/v2/statistics/banners/summary.json"
+        url = self._stats_summary_url
         params = {"id": ",".join(map(str, banner_ids)), "metrics": "base"}
-        resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-        data = resp.json()
-
-        result: Dict[int, Dict[str, Any]] = {}
-        for it in data.get("items", []) or []:
-            try:
-                _id = int(it.get("id"))
-            except Exception:
-                continue
-
-            total = it.get("total", {}) or {}
-            base = (total.get("base", {}) or {}).copy()
-            vk = base.get("vk", {}) or {}
-
-            spent = safe_float(base.get("spent", 0))
-            cpc = safe_float(base.get("cpc", 0))
-            clicks = safe_float(base.get("clicks", base.get("clicks_count", 0)))
-            goals = safe_float(vk.get("goals", 0))
-            vk_cpa = safe_float(vk.get("cpa", 0))
-
-            result[_id] = {
-                "spent": spent,
-                "cpc": cpc,
-                "clicks": clicks,
-                "goals": goals,
-                "vk.cpa": vk_cpa,
-            }
-        return result
+        resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT, session=self.session, log=self.log)
+        # разбираем байты напрямую, без угадывания кодировки в resp.json()
+        return _parse_stats_items(json.loads(resp.content).get("items", []) or [])
 
     def stats_day_banners(self, banner_ids: List[int], date_from: str, date_to: str) -> Dict[int, Dict[str, Any]]:
         if not banner_ids:
             return {}
-        url = f"{self.base_url}/api/v2/statistics/banners/day.json"
+        url = self._stats_day_url
         params = {"id": ",".join(map(str, banner_ids)), "date_from": date_from, "date_to": date_to, "metrics": "base"}
-        resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-        data = resp.json()
-
-        result: Dict[int, Dict[str, Any]] = {}
-        for it in data.get("items", []) or []:
-            try:
-                _id = int(it.get("id"))
-            except Exception:
-                continue
-
-            total = it.get("total", {}) or {}
-            base = (total.get("base", {}) or {}).copy()
-            vk = base.get("vk", {}) or {}
-
-            spent = safe_float(base.get("spent", 0))
-            cpc = safe_float(base.get("cpc", 0))
-            clicks = safe_float(base.get("clicks", base.get("clicks_count", 0)))
-            goals = safe_float(vk.get("goals", 0))
-            vk_cpa = safe_float(vk.get("cpa", 0))
-
-            result[_id] = {
-                "spent": spent,
-                "cpc": cpc,
-                "clicks": clicks,
-                "goals": goals,
-                "vk.cpa": vk_cpa,
-            }
-        return result
+        resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT, session=self.session, log=self.log)
+        # разбираем байты напрямую, без угадывания кодировки в resp.json()
+        return _parse_stats_items(json.loads(resp.content).get("items", []) or [])
 
     def disable_banner(self, banner_id: int) -> bool:
         if self.dry_run:
-            logger.warning(f"🧪 [DRY RUN] Баннер {banner_id} НЕ отключен (тестовый режим)")
+            self.log.warning(f"🧪 [DRY RUN] Баннер {banner_id} НЕ отключен (тестовый режим)")
             return True
-        url = f"{self.base_url}/api/v2/banners/{banner_id}.json"
+        url = self._banner_by_id_url_fmt.format(id=banner_id)
         try:
             resp = req_with_retry(
                 method="POST",
                 url=url,
-                headers={**self.headers, "Content-Type": "application/json"},
-                json_body={"status": "blocked"},
+                headers=self._json_headers,
+                content=_STATUS_BODIES["blocked"],
                 timeout=WRITE_TIMEOUT,
+                session=self.session,
+                log=self.log,
             )
             if resp.status_code == 204:
-                logger.warning("⤷ Баннер успешно отключен (HTTP 204)")
+                self.log.warning(f"⤷ Баннер {banner_id} успешно отключен (HTTP 204)")
                 return True
-            logger.warning(f"Не удалось отключить баннер {banner_id}: {resp.status_code} {resp.text}")
+            self.log.warning(f"Не удалось отключить баннер {banner_id}: {resp.status_code} {resp.text}")
             return False
         except Exception as e:
-            logger.error(f"Ошибка при отключении баннера {banner_id}: {e}")
+            self.log.error(f"Ошибка при отключении баннера {banner_id}: {e}")
             return False
 
     def enable_banner(self, banner_id: int) -> bool:
         if self.dry_run:
-            logger.warning(f"🧪 [DRY RUN] Баннер {banner_id} НЕ включен (тестовый режим)")
+            self.log.warning(f"🧪 [DRY RUN] Баннер {banner_id} НЕ включен (тестовый режим)")
             return True
-        url = f"{self.base_url}/api/v2/banners/{banner_id}.json"
+        url = self._banner_by_id_url_fmt.format(id=banner_id)
         try:
             resp = req_with_retry(
                 method="POST",
                 url=url,
-                headers={**self.headers, "Content-Type": "application/json"},
-                json_body={"status": "active"},
+                headers=self._json_headers,
+                content=_STATUS_BODIES["active"],
                 timeout=WRITE_TIMEOUT,
+                session=self.session,
+                log=self.log,
             )
             if resp.status_code == 204:
-                logger.info("↩ Баннер успешно включён (HTTP 204)")
+                self.log.info(f"↩ Баннер {banner_id} успешно включён (HTTP 204)")
                 return True
-            logger.warning(f"Не удалось включить баннер {banner_id}: {resp.status_code} {resp.text}")
+            self.log.warning(f"Не удалось включить баннер {banner_id}: {resp.status_code} {resp.text}")
             return False
         except Exception as e:
-            logger.error(f"Ошибка при включении баннера {banner_id}: {e}")
+            self.log.error(f"Ошибка при включении баннера {banner_id}: {e}")
             return False
 
+    def _set_banners_status_bulk(self, banner_ids: List[int], status: str) -> List[int]:
+        """
+        Меняем статус пачкой: POST /api/v2/banners/mass_action.json (до 200 баннеров за запрос).
+        Если пачку не приняли — откатываемся на поштучные disable_banner / enable_banner.
+        Возвращает id баннеров, у которых статус реально сменился.
+        """
+        single = self.disable_banner if status == "blocked" else self.enable_banner
+        if not banner_ids:
+            return []
+        if self.dry_run:
+            return [bid for bid in banner_ids if single(bid)]
+
+        url = self._mass_action_url
+        done: List[int] = []
+        for chunk in chunked(banner_ids, 200):
+            try:
+                resp = req_with_retry(
+                    method="POST",
+                    url=url,
+                    headers=self._json_headers,
+                    json_body=[{"id": bid, "status": status} for bid in chunk],
+                    timeout=WRITE_TIMEOUT,
+                    session=self.session,
+                    log=self.log,
+                    retry_client_errors=False,
+                )
+                if resp.status_code == 204:
+                    self.log.warning(f"⤷ mass_action status={status}: баннеров {len(chunk)} (HTTP 204)")
+                    done.extend(chunk)
+                    continue
+                if resp.status_code == 200:
+                    # 200 с телом: верим только явно подтверждённым id, остальные — поштучно
+                    applied = _mass_action_applied(resp, status)
+                    ok = [bid for bid in chunk if bid in applied]
+                    rest = [bid for bid in chunk if bid not in applied]
+                    done.extend(ok)
+                    self.log.warning(
+                        f"⤷ mass_action status={status}: подтверждено {len(ok)} из {len(chunk)} (HTTP 200)"
+                        + (" — остальные меняем по одному" if rest else "")
+                    )
+                    done.extend(bid for bid in rest if single(bid))
+                    continue
+                self.log.warning(f"mass_action status={status} не принят: {resp.status_code} {resp.text} — меняем по одному")
+            except Exception as e:
+                self.log.warning(f"mass_action status={status} не прошёл: {e} — меняем по одному")
+            done.extend(bid for bid in chunk if single(bid))
+        return done
+
+    def disable_banners_bulk(self, banner_ids: List[int]) -> List[int]:
+        return self._set_banners_status_bulk(banner_ids, "blocked")
+
+    def enable_banners_bulk(self, banner_ids: List[int]) -> List[int]:
+        return self._set_banners_status_bulk(banner_ids, "active")
+
     def build_groups_objective_cache(self, group_ids: List[int]) -> Dict[int, str]:
         """
         Получаем objective по ad_group_id:
         GET /api/v2/ad_groups.json?_id__in=...&fields=id,objective
         Возвращаем mapping: group_id -> objective
+        Группы со свежей (моложе OBJECTIVES_CACHE_TTL_SEC) записью в дисковом кэше не запрашиваются.
         """
-        url = f"{self.base_url}/api/v2/ad_groups.json"
+        url = self._ad_groups_url
         mapping: Dict[int, str] = {}
     
         uniq = sorted({int(x) for x in group_ids if int(x) > 0})
         if not uniq:
             return mapping
+
+        now = time.time()
+        to_fetch: List[int] = []
+        for gid in uniq:
+            cached = self.group_objective_cache.get(gid)
+            if cached is not None and now - cached[1] < OBJECTIVES_CACHE_TTL_SEC:
+                mapping[gid] = cached[0]
+            else:
+                to_fetch.append(gid)
+        if not to_fetch:
+            self.log.info(f"✅ objective по группам из кэша: groups={len(mapping)}")
+            return mapping
     
-        chunk_size = 200
-        for i in range(0, len(uniq), chunk_size):
-            chunk = uniq[i:i + chunk_size]
-            params = {
-                "_id__in": ",".join(map(str, chunk)),
-                "limit": len(chunk),
-                "fields": "id,objective",
-            }
-            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-            data = resp.json()
+        responses = self._get_chunks(
+            url,
+            list(chunked(to_fetch, 200)),
+            lambda chunk: {"_id__in": ",".join(map(str, chunk)), "limit": len(chunk), "fields": "id,objective"},
+        )
+        for n, data in enumerate(responses, start=1):
             items = data.get("items", []) or []
     
             for g in items:
@@ -567,11 +982,16 @@ class VkAdsApi:
                     gid = int(g.get("id"))
                 except Exception:
                     continue
-                mapping[gid] = (g.get("objective") or "").strip()
+                objective = (g.get("objective") or "").strip()
+                mapping[gid] = objective
+                self.group_objective_cache[gid] = (objective, now)
     
-            logger.info(f"ad_groups _id__in chunk {i // chunk_size + 1}: groups={len(items)}")
+            self.log.info(f"ad_groups _id__in chunk {n}: groups={len(items)}")
+
+        if self.objectives_cache_path is not None:
+            save_objectives_cache(self.objectives_cache_path, self.group_objective_cache)
     
-        logger.info(f"✅ Загружены objective по группам: groups_with_objective={len(mapping)}")
+        self.log.info(f"✅ Загружены objective по группам: groups_with_objective={len(mapping)}")
         return mapping
 
     def fetch_group_ids_from_campaigns(self, campaign_ids: List[int]) -> List[int]:
@@ -583,20 +1003,20 @@ class VkAdsApi:
         if not uniq:
             return []
 
-        url = f"{self.base_url}/api/v2/ad_plans.json"
+        url = self._ad_plans_url
         out: List[int] = []
-        chunk_size = 200
 
-        for i in range(0, len(uniq), chunk_size):
-            chunk = uniq[i:i + chunk_size]
-            params = {
+        responses = self._get_chunks(
+            url,
+            list(chunked(uniq, 200)),
+            lambda chunk: {
                 "_status": "active",
                 "limit": 200,
                 "_id__in": ",".join(map(str, chunk)),
                 "fields": "id,name,ad_groups",
-            }
-            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-            data = resp.json()
+            },
+        )
+        for data in responses:
             items = data.get("items", []) or []
 
             for plan in items:
@@ -622,20 +1042,20 @@ class VkAdsApi:
         if not uniq:
             return []
 
-        url = f"{self.base_url}/api/v2/ad_groups.json"
+        url = self._ad_groups_url
         out: List[int] = []
-        chunk_size = 200
 
-        for i in range(0, len(uniq), chunk_size):
-            chunk = uniq[i:i + chunk_size]
-            params = {
+        responses = self._get_chunks(
+            url,
+            list(chunked(uniq, 200)),
+            lambda chunk: {
                 "_status": "active",
                 "limit": 200,
                 "_id__in": ",".join(map(str, chunk)),
                 "fields": "id,name,banners",
-            }
-            resp = req_with_retry("GET", url, headers=self.headers, params=params, timeout=STATS_TIMEOUT)
-            data = resp.json()
+            },
+        )
+        for data in responses:
             items = data.get("items", []) or []
 
             for g in items:
@@ -655,49 +1075,86 @@ class VkAdsApi:
 # ============================================================
 # Filters engine
 # ============================================================
-def op_compare(left: float, op: str, right: float) -> bool:
-    op = (op or "").upper()
-    if op == "LT":
-        return left < right
-    if op == "LTE":
-        return left <= right
-    if op == "EQ":
-        return abs(left - right) < 1e-9
-    if op == "GTE":
-        return left >= right
-    if op == "GT":
-        return left > right
+# Операторы сравнения: строка op один раз в compile_templates превращается в функцию,
+# дальше по баннерам — прямой вызов без цепочки сравнений строк
+OpFunc = Callable[[float, float], bool]
+
+
+def _op_eq(left: float, right: float) -> bool:
+    return abs(left - right) < 1e-9
+
+
+def _op_never(left: float, right: float) -> bool:
+    # неизвестный/пустой op — условие не выполняется
     return False
 
 
-def daterange_from_period(period: Dict[str, Any]) -> Optional[Tuple[str, str]]:
-    ptype = (period or {}).get("type", "ALL_TIME")
-    today = dt.date.today()
+_OP_TABLE: Dict[str, OpFunc] = {
+    "LT": operator.lt,
+    "LTE": operator.le,
+    "EQ": _op_eq,
+    "GTE": operator.ge,
+    "GT": operator.gt,
+}
+
+
+def op_func(op: Any) -> OpFunc:
+    return _OP_TABLE.get(str(op or "").upper(), _op_never)
+
+
+@lru_cache(maxsize=128)
+def _daterange_cached(ptype: str, n: int, today_ordinal: int) -> Optional[Tuple[str, str]]:
+    today = dt.date.fromordinal(today_ordinal)
 
     if ptype == "ALL_TIME":
         return None
     if ptype == "TODAY":
-        d = today.strftime("%Y-%m-%d")
+        d = today.isoformat()
         return (d, d)
     if ptype == "YESTERDAY":
-        d = (today - dt.timedelta(days=1)).strftime("%Y-%m-%d")
+        d = (today - dt.timedelta(days=1)).isoformat()
         return (d, d)
     if ptype == "LAST_N_DAYS":
-        n = int((period or {}).get("n", 1) or 1)
         n = max(1, n)
-        date_from = (today - dt.timedelta(days=n - 1)).strftime("%Y-%m-%d")
-        date_to = today.strftime("%Y-%m-%d")
+        date_from = (today - dt.timedelta(days=n - 1)).isoformat()
+        date_to = today.isoformat()
         return (date_from, date_to)
 
     return None
 
 
+def _period_parts(period: Dict[str, Any]) -> Tuple[str, int]:
+    ptype = str((period or {}).get("type", "ALL_TIME"))
+    n = int((period or {}).get("n", 1) or 1) if ptype == "LAST_N_DAYS" else 0
+    return ptype, n
+
+
+def daterange_from_period(period: Dict[str, Any], today: Optional[dt.date] = None) -> Optional[Tuple[str, str]]:
+    """today можно посчитать один раз на прогон и передать; результат кешируется по (type, n, today)."""
+    ptype, n = _period_parts(period)
+    if today is None:
+        today = dt.date.today()
+    return _daterange_cached(ptype, n, today.toordinal())
+
+
 def metric_value_from_stats(stats: Dict[str, Any]) -> Dict[str, float]:
-    spent = safe_float(stats.get("spent", 0))
-    clicks = safe_float(stats.get("clicks", 0))
-    goals = safe_float(stats.get("goals", 0))
-    cpc = safe_float(stats.get("cpc", 0))
-    vk_cpa = safe_float(stats.get("vk.cpa", 0))
+    # _parse_stats_items уже привёл значения к float — safe_float зовём только для «чужих» типов
+    get = stats.get
+    spent = get("spent", 0.0)
+    if type(spent) is not float:
+        spent = safe_float(spent)
+    clicks = get("clicks", 0.0)
+    if type(clicks) is not float:
+        clicks = safe_float(clicks)
+    goals = get("goals", 0.0)
+    if type(goals) is not float:
+        goals = safe_float(goals)
+    cpc = get("cpc", 0.0)
+    if type(cpc) is not float:
+        cpc = safe_float(cpc)
+    vk_cpa = get("vk.cpa", 0.0)
+    if type(vk_cpa) is not float:
+        vk_cpa = safe_float(vk_cpa)
 
     click_cost = cpc if cpc > 0 else (spent / clicks if clicks > 0 else 0.0)
     result_cost = vk_cpa if vk_cpa > 0 else (spent / goals if goals > 0 else 0.0)
@@ -712,20 +1169,50 @@ def metric_value_from_stats(stats: Dict[str, Any]) -> Dict[str, float]:
         "CPA": result_cost,
     }
 
-def period_to_label(period: Dict[str, Any]) -> str:
-    """Человеческое описание периода + (если нужно) диапазон дат."""
-    ptype = (period or {}).get("type", "ALL_TIME")
-    dr = daterange_from_period(period)
+# Общий пустой dict для "нет статистики" — только для чтения, не мутировать!
+_EMPTY_STATS: Dict[Any, Any] = {}
 
+# id(stats) -> metric_value_from_stats(stats); живёт в пределах решения по одному баннеру,
+# пока все stats-dict'ы гарантированно живы (stats_by_period / _EMPTY_STATS), так что id не переиспользуются.
+MetricCache = Dict[int, Dict[str, float]]
+
+
+def metric_value_cached(stats: Dict[str, Any], mv_cache: Optional[MetricCache]) -> Dict[str, float]:
+    """metric_value_from_stats с мемоизацией по id(stats). Результат только для чтения."""
+    if mv_cache is None:
+        return metric_value_from_stats(stats)
+    mv = mv_cache.get(id(stats))
+    if mv is None:
+        mv = mv_cache[id(stats)] = metric_value_from_stats(stats)
+    return mv
+
+
+# period_id -> {banner_id: stats}
+StatsByPeriod = Dict[int, Dict[int, Dict[str, Any]]]
+
+
+def get_stats(
+    stats_by_period: StatsByPeriod,
+    pid: int,
+    banner_id: int,
+) -> Dict[str, Any]:
+    by_banner = stats_by_period.get(pid)
+    if not by_banner:
+        return _EMPTY_STATS
+    return by_banner.get(banner_id) or _EMPTY_STATS
+
+
+@lru_cache(maxsize=128)
+def _period_label_cached(ptype: str, n: int, today_ordinal: int) -> str:
     if ptype == "ALL_TIME":
         return "Период: за всё время"
 
+    dr = _daterange_cached(ptype, n, today_ordinal)
     if not dr:
         return f"Период: {ptype}"
 
     date_from, date_to = dr
     if ptype == "LAST_N_DAYS":
-        n = int((period or {}).get("n", 1) or 1)
         return f"Период: последние {n} дн. ({date_from}..{date_to})"
 
     if ptype == "TODAY":
@@ -737,54 +1224,88 @@ def period_to_label(period: Dict[str, Any]) -> str:
     return f"Период: {ptype} ({date_from}..{date_to})"
 
 
+def period_to_label(period: Dict[str, Any], today: Optional[dt.date] = None) -> str:
+    """Человеческое описание периода + (если нужно) диапазон дат."""
+    ptype, n = _period_parts(period)
+    if today is None:
+        today = dt.date.today()
+    return _period_label_cached(ptype, n, today.toordinal())
+
+
+@dataclass
+class CheckContext:
+    """
+    Общее для одного прогона кабинета: "сегодня" фиксируется один раз, чтобы статистика,
+    доходы и подписи периодов считались от одной даты (даже если прогон перевалил за полночь).
+    """
+    today: dt.date = field(default_factory=dt.date.today)
+    today_ordinal: int = 0
+    # id(period) -> (period, подпись); period держим в значении, чтобы id не переиспользовался
+    _labels: Dict[int, Tuple[Any, str]] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self) -> None:
+        self.today_ordinal = self.today.toordinal()
+
+    def period_label(self, period: Mapping[str, Any]) -> str:
+        hit = self._labels.get(id(period))
+        if hit is not None:
+            return hit[1]
+        ptype, n = _period_parts(period)
+        label = _period_label_cached(ptype, n, self.today_ordinal)
+        self._labels[id(period)] = (period, label)
+        return label
+
+
 def log_banner_stats(
     banner_id: int,
     periods: List[Dict[str, Any]],
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-    income_store: IncomeStore,
+    stats_by_period: StatsByPeriod,
+    income_by_period: Dict[Tuple[str, int], Dict[int, float]],
     target_action: str = "",
+    ctx: Optional[CheckContext] = None,
+    log: Log = logger,
 ) -> None:
     """Печатает статистику баннера по ALL_TIME и всем периодам из filters.json."""
-    all_time_key = json.dumps({"type": "ALL_TIME"}, sort_keys=True, ensure_ascii=False)
+    # в проде (WARNING/ERROR) ничего не считаем и не форматируем
+    if not log.isEnabledFor(logging.INFO):
+        return
 
     # ALL_TIME
-    s_all = (stats_by_period.get(all_time_key, {}) or {}).get(banner_id, {}) or {}
+    s_all = get_stats(stats_by_period, ALL_TIME_ID, banner_id)
     mv_all = metric_value_from_stats(s_all)
-    inc_all = income_store.income_for_period(banner_id, {"type": "ALL_TIME"})
+    inc_all = income_by_period.get(INCOME_ALL_TIME_KEY, {}).get(banner_id, 0.0)
 
+    # одна запись лога на баннер (ALL_TIME + все периоды строками), а не 1 + len(periods) вызовов logger.info
     ta_txt = f" target_action={target_action}" if target_action else ""
-    logger.info(
-        f"[BANNER {banner_id}]{ta_txt} ALL_TIME: "
-        f"spent_all_time={mv_all['SPENT']:.2f} "
-        f"cpa_all_time={mv_all['RESULT_COST']:.2f} "
-        f"cpc_all_time={mv_all['CLICK_COST']:.2f} "
-        f"clicks_all_time={mv_all['CLICKS']:.0f} "
-        f"results_all_time={mv_all['RESULTS']:.0f} "
-        f"income_all_time={inc_all:.2f}"
-    )
+    lines = [
+        "[BANNER %s]%s ALL_TIME: spent_all_time=%.2f cpa_all_time=%.2f cpc_all_time=%.2f "
+        "clicks_all_time=%.0f results_all_time=%.0f income_all_time=%.2f" % (
+            banner_id, ta_txt, mv_all["SPENT"], mv_all["RESULT_COST"], mv_all["CLICK_COST"],
+            mv_all["CLICKS"], mv_all["RESULTS"], inc_all,
+        )
+    ]
 
     # Остальные периоды из filters.json
+    label = ctx.period_label if ctx is not None else period_to_label
     for p in periods:
         if not isinstance(p, dict):
             continue
         if (p.get("type") or "ALL_TIME") == "ALL_TIME":
             continue
 
-        key = json.dumps(p, sort_keys=True, ensure_ascii=False)
-        s = (stats_by_period.get(key, {}) or {}).get(banner_id, {}) or {}
+        s = get_stats(stats_by_period, period_id(p), banner_id)
         mv = metric_value_from_stats(s)
-        inc = income_store.income_for_period(banner_id, p)
-
-        logger.info(
-            f"[BANNER {banner_id}] PERIOD {period_to_label(p)}: "
-            f"spent={mv['SPENT']:.2f} "
-            f"cpa={mv['RESULT_COST']:.2f} "
-            f"cpc={mv['CLICK_COST']:.2f} "
-            f"clicks={mv['CLICKS']:.0f} "
-            f"results={mv['RESULTS']:.0f} "
-            f"income={inc:.2f}"
+        inc = income_by_period.get(income_period_key(p), {}).get(banner_id, 0.0)
+
+        lines.append(
+            "[BANNER %s] PERIOD %s: spent=%.2f cpa=%.2f cpc=%.2f clicks=%.0f results=%.0f income=%.2f" % (
+                banner_id, label(p), mv["SPENT"], mv["RESULT_COST"], mv["CLICK_COST"],
+                mv["CLICKS"], mv["RESULTS"], inc,
+            )
         )
 
+    log.info("\n".join(lines))
+
 def extract_templates(filters_json: Any) -> List[Dict[str, Any]]:
     if isinstance(filters_json, dict):
         tpls = filters_json.get("templates")
@@ -797,109 +1318,322 @@ def extract_templates(filters_json: Any) -> List[Dict[str, Any]]:
     return []
 
 
-def accounts_scope_allows(accounts_scope: Dict[str, Any], cabinet_id: str) -> bool:
+# Тип условия/режим INCOME/метрика — всё нормализуется один раз при компиляции шаблонов,
+# по баннерам дальше читаем готовые поля вместо .get().upper().strip() на каждый вызов.
+_INCOME_HAS_MODES = frozenset(("HAS", "EXISTS"))
+_INCOME_HAS_NOT_MODES = frozenset(("HAS_NOT", "NOT_HAS", "NOT", "NONE", "NO", "EMPTY", "ZERO"))
+_STATE_VALUES = frozenset(("DISABLE", "ENABLE", "NOOP"))
+# ключи, которые отдаёт metric_value_from_stats
+_METRIC_KEYS = frozenset(("SPENT", "CLICKS", "RESULTS", "CLICK_COST", "RESULT_COST", "CPC", "CPA"))
+
+
+@dataclass
+class CompiledCondition:
+    """Условие conditions[] (SPENT / INCOME / TARGET_ACTION) в разобранном виде."""
+    # без __slots__: значения по умолчанию dataclass хранит атрибутами класса, а они конфликтуют со слотами
+    ctype: str
+    op: str = ""                 # как было в шаблоне (upper) — для текста причины
+    cmp: OpFunc = _op_never
+    mode: str = ""               # INCOME: HAS / HAS_NOT / COMPARE / COMPARE_SPEND / ...
+    value: float = 0.0           # SPENT/COMPARE: valueRub; COMPARE_SPEND: multiplier
+    period: Mapping[str, Any] = field(default_factory=lambda: ALL_TIME_PERIOD)
+    period_id: int = ALL_TIME_ID
+    income_key: Tuple[str, int] = INCOME_ALL_TIME_KEY
+    spend_period: Mapping[str, Any] = field(default_factory=lambda: ALL_TIME_PERIOD)
+    spend_period_id: int = ALL_TIME_ID
+    target: str = ""
+
+
+@dataclass
+class CompiledCostRule:
+    # __slots__ пишем сами: dataclass(slots=True) есть только с Python 3.10
+    __slots__ = ("metric", "op", "cmp", "value", "spent_rub", "period", "period_id")
+
+    metric: str
+    op: str
+    cmp: OpFunc
+    value: float
+    spent_rub: float
+    period: Mapping[str, Any]
+    period_id: int
+
+
+@dataclass
+class CompiledFilterNode:
+    __slots__ = ("mode", "conditions", "rules", "result_cost_rule", "action_state", "child")
+
+    mode: str
+    conditions: Tuple[CompiledCondition, ...]
+    # None — элемент rules, который не COST_RULE (никогда не срабатывает, но в rules считается)
+    rules: Tuple[Optional[CompiledCostRule], ...]
+    # первое правило RESULT_COST/CPA — от него зависит, учитывается ли CLICK_COST
+    result_cost_rule: Optional[CompiledCostRule]
+    # SET_STATE action; None — action нет/невалидный
+    action_state: Optional[str]
+    child: Optional["CompiledFilterNode"]
+
+
+@dataclass
+class CompiledTemplate:
+    __slots__ = (
+        "name",
+        "priority",
+        "allowed_cabinets",
+        "conditions",
+        "check_conditions",
+        "has_conditions",
+        "direct_state",
+        "child",
+        "raw",
+    )
+
+    name: str
+    priority: int
+    # кабинеты из accountsScope (строковые id); None — шаблон для всех кабинетов
+    allowed_cabinets: Optional[frozenset[str]]
+    # conditions — в порядке шаблона (для текста причины), check_conditions — в порядке проверки
+    conditions: Tuple[CompiledCondition, ...]
+    check_conditions: Tuple[CompiledCondition, ...]
+    # conditions в root заданы (непустой список) — от этого зависит прямой action у child
+    has_conditions: bool
+    # state из child-FILTER без rules (срабатывает сразу после root conditions)
+    direct_state: Optional[str]
+    child: Optional[CompiledFilterNode]
+    # исходный шаблон — для сбора периодов (collect_periods_from_filters)
+    raw: Dict[str, Any]
+
+
+def _compile_condition(cond: Dict[str, Any]) -> CompiledCondition:
+    ctype = str(cond.get("type") or "").upper()
+    period = cond.get("period") or ALL_TIME_PERIOD
+
+    # умолчания — те же, что раньше были в месте сравнения
+    if ctype == "SPENT":
+        return CompiledCondition(
+            ctype=ctype,
+            op=(cond.get("op") or "GTE").upper(),
+            cmp=op_func(cond.get("op", "GTE")),
+            value=safe_float(cond.get("valueRub", 0)),
+            period=period,
+            period_id=period_id(period),
+        )
+
+    if ctype == "INCOME":
+        mode = (cond.get("mode") or "HAS").upper()
+        if mode == "COMPARE_SPEND":
+            value = safe_float(cond.get("multiplier", 0))
+        else:
+            value = safe_float(cond.get("valueRub", cond.get("value", 0)))
+        spend_period = cond.get("spendPeriod") or ALL_TIME_PERIOD
+        return CompiledCondition(
+            ctype=ctype,
+            op=(cond.get("op") or "").upper().strip(),
+            cmp=op_func(str(cond.get("op") or "").strip()),
+            mode=mode,
+            value=value,
+            period=period,
+            period_id=period_id(period),
+            income_key=income_period_key(period),
+            spend_period=spend_period,
+            spend_period_id=period_id(spend_period),
+        )
+
+    if ctype == "TARGET_ACTION":
+        return CompiledCondition(ctype=ctype, target=(cond.get("target") or "").strip())
+
+    # неизвестный тип: eval_conditions => False, в причину не попадает
+    return CompiledCondition(ctype=ctype)
+
+
+def _compile_conditions(conditions: Any) -> Tuple[CompiledCondition, ...]:
+    if not isinstance(conditions, list):
+        return ()
+    return tuple(_compile_condition(c) for c in conditions if isinstance(c, dict))
+
+
+# Порядок проверки условий (AND, результат от порядка не зависит): сначала дешёвые —
+# TARGET_ACTION (сравнение строк) и неизвестные типы (сразу False), потом SPENT, потом INCOME.
+_COND_CHECK_COST: Dict[str, int] = {"TARGET_ACTION": 0, "SPENT": 1, "INCOME": 2}
+
+
+def _check_order(conditions: Tuple[CompiledCondition, ...]) -> Tuple[CompiledCondition, ...]:
+    return tuple(sorted(conditions, key=lambda c: _COND_CHECK_COST.get(c.ctype, 0)))
+
+
+def _compile_cost_rule(rule: Any) -> Optional[CompiledCostRule]:
+    if not isinstance(rule, dict) or (rule.get("type") or "").upper() != "COST_RULE":
+        return None
+    period = rule.get("period") or ALL_TIME_PERIOD
+    return CompiledCostRule(
+        metric=(rule.get("metric") or "").upper(),
+        op=(rule.get("op") or "EQ").upper(),
+        cmp=op_func(rule.get("op") or "EQ"),
+        value=safe_float(rule.get("value", rule.get("valueRub", 0))),
+        spent_rub=safe_float(rule.get("spentRub", 0)),
+        period=period,
+        period_id=period_id(period),
+    )
+
+
+def _action_state(action: Any) -> Optional[str]:
+    if isinstance(action, dict) and (action.get("type") or "").upper() == "SET_STATE":
+        state = (action.get("state") or "NOOP").upper()
+        if state in _STATE_VALUES:
+            return state
+    return None
+
+
+def _node_rules(node: Dict[str, Any]) -> List[Any]:
+    rules = node.get("rules") or []
+    return rules if isinstance(rules, list) else []
+
+
+def _compile_filter_chain(node: Any) -> Optional[CompiledFilterNode]:
+    """Цепочка child → связный список FILTER-узлов (не-FILTER узлы просто пропускаются)."""
+    filters: List[Dict[str, Any]] = []
+    while isinstance(node, dict):
+        if (node.get("type") or "").upper() == "FILTER":
+            filters.append(node)
+        node = node.get("child")
+
+    compiled: Optional[CompiledFilterNode] = None
+    for fnode in reversed(filters):
+        rules = tuple(_compile_cost_rule(r) for r in _node_rules(fnode))
+        result_cost_rule = next(
+            (r for r in rules if r is not None and r.metric in ("RESULT_COST", "CPA")), None
+        )
+        compiled = CompiledFilterNode(
+            mode=(fnode.get("mode") or "ALL").upper(),
+            conditions=_check_order(_compile_conditions(fnode.get("conditions"))),
+            rules=rules,
+            result_cost_rule=result_cost_rule,
+            action_state=_action_state(fnode.get("action") or {}),
+            child=compiled,
+        )
+    return compiled
+
+
+def compile_templates(templates: List[Dict[str, Any]]) -> List[CompiledTemplate]:
+    """
+    Готовит шаблоны к прогону по баннерам (один раз на пользователя):
+    условия/правила разбираются в CompiledCondition / CompiledCostRule (функции сравнения, пороги,
+    id периодов и ключи доходов), accountsScope — в frozenset строковых id кабинетов (allowed_cabinets).
+    Шаблоны без root-словаря отбрасываются, остальные сразу сортируются по priority.
+    Исходные шаблоны не меняются.
+    """
+    compiled: List[CompiledTemplate] = []
+    for tpl in templates:
+        if not isinstance(tpl, dict):
+            continue
+        root = template_root(tpl)
+        if not isinstance(root, dict):
+            continue
+
+        conditions = root.get("conditions") or []
+        has_conditions = bool(isinstance(conditions, list) and conditions)
+        root_conditions = _compile_conditions(conditions)
+
+        child = root.get("child") or {}
+        direct_state: Optional[str] = None
+        if isinstance(child, dict) and (child.get("type") or "").upper() == "FILTER" and not _node_rules(child):
+            direct_state = _action_state(child.get("action") or {})
+
+        compiled.append(CompiledTemplate(
+            name=str(tpl.get("name") or tpl.get("id") or "").strip(),
+            priority=int(tpl.get("priority", 9999) or 9999),
+            allowed_cabinets=allowed_cabinets_from_scope(root.get("accountsScope") or {}),
+            conditions=root_conditions,
+            check_conditions=_check_order(root_conditions),
+            has_conditions=has_conditions,
+            direct_state=direct_state,
+            child=_compile_filter_chain(child),
+            raw=tpl,
+        ))
+    # сортировка устойчивая — при равном priority сохраняется порядок из filters.json
+    compiled.sort(key=lambda x: x.priority)
+    return compiled
+
+
+def allowed_cabinets_from_scope(accounts_scope: Any) -> Optional[frozenset[str]]:
+    """
+    accountsScope -> множество строковых id кабинетов, где шаблон действует; None — везде.
+    Считается один раз в compile_templates; неизвестный mode / SELECTED без списка — ни одного кабинета.
+    """
     if not isinstance(accounts_scope, dict):
-        return True
+        return None
     mode = (accounts_scope.get("mode") or "ALL").upper()
     if mode == "ALL":
-        return True
+        return None
     if mode == "SELECTED":
         selected = accounts_scope.get("selected") or accounts_scope.get("accounts") or accounts_scope.get("ids")
         if isinstance(selected, list):
-            return str(cabinet_id) in {str(x) for x in selected}
-        return False
-    return False
+            return frozenset(str(x) for x in selected)
+    return frozenset()
 
 
-def objective_to_target_action(objective: str) -> str:
-    obj = (objective or "").strip()
-    if obj == "socialengagement":
-        return "BOT_MESSAGE"
-    if obj == "site_conversions":
-        return "SITE"
-    if obj == "leadads":
-        return "LEADFORM"
-    # всё остальное
-    return "APP"
+# objective группы -> target_action; всё остальное — APP
+_OBJECTIVE_TARGET_ACTION: Mapping[str, str] = MappingProxyType({
+    "socialengagement": "BOT_MESSAGE",
+    "site_conversions": "SITE",
+    "leadads": "LEADFORM",
+})
 
 
-def banner_target_action_from_groups(ad_group_id: int, group_objectives: Dict[int, str]) -> str:
-    objective = group_objectives.get(int(ad_group_id), "")
-    return objective_to_target_action(objective)
+def objective_to_target_action(objective: str) -> str:
+    return _OBJECTIVE_TARGET_ACTION.get((objective or "").strip(), "APP")
 
 
 def eval_conditions(
-    conditions: List[Dict[str, Any]],
+    conditions: Iterable[CompiledCondition],
     banner_id: int,
-    banner_obj: Dict[str, Any],
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-    income_store: IncomeStore,
-    banner_objectives: Dict[int, str],
+    stats_by_period: StatsByPeriod,
+    income_by_period: Dict[Tuple[str, int], Dict[int, float]],
+    target_action: str,
+    mv_cache: Optional[MetricCache] = None,
 ) -> bool:
-    for cond in conditions or []:
-        if not isinstance(cond, dict):
-            continue
-
-        ctype = (cond.get("type") or "").upper()
+    for cond in conditions:
+        ctype = cond.ctype
 
         if ctype == "SPENT":
-            period = cond.get("period") or {"type": "ALL_TIME"}
-            key = json.dumps(period, sort_keys=True, ensure_ascii=False)
-            stats = stats_by_period.get(key, {}).get(banner_id, {}) or {}
-            mv = metric_value_from_stats(stats)
-            op = cond.get("op", "GTE")
-            value = safe_float(cond.get("valueRub", 0))
-            if not op_compare(mv["SPENT"], op, value):
+            stats = get_stats(stats_by_period, cond.period_id, banner_id)
+            mv = metric_value_cached(stats, mv_cache)
+            if not cond.cmp(mv["SPENT"], cond.value):
                 return False
 
         elif ctype == "INCOME":
-            period = cond.get("period") or {"type": "ALL_TIME"}
-            income = income_store.income_for_period(banner_id, period)
-        
-            mode = (cond.get("mode") or "HAS").upper()
-        
-            if mode in ("HAS", "EXISTS"):
+            income = income_by_period.get(cond.income_key, _EMPTY_STATS).get(banner_id, 0.0)
+            mode = cond.mode
+
+            if mode in _INCOME_HAS_MODES:
                 if income <= 0:
                     return False
-        
-            elif mode in ("HAS_NOT", "NOT_HAS", "NOT", "NONE", "NO", "EMPTY", "ZERO"):
+
+            elif mode in _INCOME_HAS_NOT_MODES:
                 if income > 0:
                     return False
-        
+
             elif mode == "COMPARE":
-                op = (cond.get("op") or "").upper().strip()
-                if not op:
+                if not cond.cmp(income, cond.value):
                     return False
-                value = safe_float(cond.get("valueRub", cond.get("value", 0)))
-                if not op_compare(income, op, value):
-                    return False
-        
+
             elif mode == "COMPARE_SPEND":
-                op = (cond.get("op") or "").upper().strip()
-                if not op:
+                if cond.cmp is _op_never:
                     return False
-        
-                threshold = safe_float(cond.get("multiplier", 0))
-        
-                spend_period = cond.get("spendPeriod") or {"type": "ALL_TIME"}
-                spend_key = json.dumps(spend_period, sort_keys=True, ensure_ascii=False)
-                spend_stats = stats_by_period.get(spend_key, {}).get(banner_id, {}) or {}
-                spend = metric_value_from_stats(spend_stats)["SPENT"]
-        
+
+                spend_stats = get_stats(stats_by_period, cond.spend_period_id, banner_id)
+                spend = metric_value_cached(spend_stats, mv_cache)["SPENT"]
+
                 delta = income - spend
-                if not op_compare(delta, op, threshold):
+                if not cond.cmp(delta, cond.value):
                     return False
-        
+
             else:
                 return False
 
         elif ctype == "TARGET_ACTION":
-            target = (cond.get("target") or "").strip()
-            if not target:
+            if not cond.target:
                 continue
-            gid = int((banner_obj or {}).get("ad_group_id") or (banner_obj.get("ad_group_id") if isinstance(banner_obj, dict) else 0) or 0)
-            actual = banner_target_action_from_groups(gid, banner_objectives)
-            if actual != target:
+            if target_action != cond.target:
                 return False
 
         else:
@@ -908,145 +1642,140 @@ def eval_conditions(
     return True
 
 def conditions_to_reason(
-    conditions: List[Dict[str, Any]],
+    conditions: Iterable[CompiledCondition],
     banner_id: int,
-    banner_obj: Dict[str, Any],
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-    income_store: IncomeStore,
-    banner_objectives: Dict[int, str],
+    stats_by_period: StatsByPeriod,
+    income_by_period: Dict[Tuple[str, int], Dict[int, float]],
+    target_action: str,
+    mv_cache: Optional[MetricCache] = None,
+    ctx: Optional[CheckContext] = None,
 ) -> Tuple[str, str]:
     """
     Возвращает (reason, short_reason) по условиям.
     Предполагается, что условия уже ПРОШЛИ (true), но мы всё равно берём фактические значения для текста.
     """
+    label = ctx.period_label if ctx is not None else period_to_label
     parts_long: List[str] = []
     parts_short: List[str] = []
 
-    for cond in conditions or []:
-        if not isinstance(cond, dict):
-            continue
-
-        ctype = (cond.get("type") or "").upper()
+    for cond in conditions:
+        ctype = cond.ctype
 
         if ctype == "SPENT":
-            period = cond.get("period") or {"type": "ALL_TIME"}
-            key = json.dumps(period, sort_keys=True, ensure_ascii=False)
-            stats = stats_by_period.get(key, {}).get(banner_id, {}) or {}
-            mv = metric_value_from_stats(stats)
+            stats = get_stats(stats_by_period, cond.period_id, banner_id)
+            mv = metric_value_cached(stats, mv_cache)
 
-            op = (cond.get("op") or "GTE").upper()
-            value = safe_float(cond.get("valueRub", 0))
+            op_h = op_to_human(cond.op)
+            value_i = fmt_int(cond.value)
 
             parts_long.append(
-                f"Расход {fmt_int(mv['SPENT'])} ₽ {op_to_human(op)} {fmt_int(value)} ₽. {period_to_label(period)}"
+                f"Расход {fmt_int(mv['SPENT'])} ₽ {op_h} {value_i} ₽. {label(cond.period)}"
             )
             parts_short.append(
-                f"Расход {fmt_int(mv['SPENT'])} {op_to_human(op)} {fmt_int(value)}"
+                f"Расход {fmt_int(mv['SPENT'])} {op_h} {value_i}"
             )
 
         elif ctype == "INCOME":
-            period = cond.get("period") or {"type": "ALL_TIME"}
-            income = income_store.income_for_period(banner_id, period)
+            income = income_by_period.get(cond.income_key, _EMPTY_STATS).get(banner_id, 0.0)
             income_i = fmt_int(income)
+            mode = cond.mode
 
-            mode = (cond.get("mode") or "HAS").upper()
-
-            if mode in ("HAS", "EXISTS"):
-                parts_long.append(f"Доход есть ({income_i} ₽). {period_to_label(period)}")
+            if mode in _INCOME_HAS_MODES:
+                parts_long.append(f"Доход есть ({income_i} ₽). {label(cond.period)}")
                 parts_short.append(f"Доход {income_i} > 0")
 
-            elif mode in ("HAS_NOT", "NOT_HAS", "NOT", "NONE", "NO", "EMPTY", "ZERO"):
-                parts_long.append(f"Доход отсутствует ({income_i} ₽). {period_to_label(period)}")
+            elif mode in _INCOME_HAS_NOT_MODES:
+                parts_long.append(f"Доход отсутствует ({income_i} ₽). {label(cond.period)}")
                 parts_short.append(f"Доход {income_i} = 0")
 
             elif mode == "COMPARE":
-                op = (cond.get("op") or "").upper().strip()
-                value = safe_float(cond.get("valueRub", cond.get("value", 0)))
-                parts_long.append(f"Доход {income_i} ₽ {op_to_human(op)} {fmt_int(value)} ₽. {period_to_label(period)}")
-                parts_short.append(f"Доход {income_i} {op_to_human(op)} {fmt_int(value)}")
+                op_h = op_to_human(cond.op)
+                parts_long.append(f"Доход {income_i} ₽ {op_h} {fmt_int(cond.value)} ₽. {label(cond.period)}")
+                parts_short.append(f"Доход {income_i} {op_h} {fmt_int(cond.value)}")
 
             elif mode == "COMPARE_SPEND":
-                op = (cond.get("op") or "").upper().strip()
-                threshold = safe_float(cond.get("multiplier", 0))
-
-                spend_period = cond.get("spendPeriod") or {"type": "ALL_TIME"}
-                spend_key = json.dumps(spend_period, sort_keys=True, ensure_ascii=False)
-                spend_stats = stats_by_period.get(spend_key, {}).get(banner_id, {}) or {}
-                spend = metric_value_from_stats(spend_stats)["SPENT"]
+                op_h = op_to_human(cond.op)
+                spend_stats = get_stats(stats_by_period, cond.spend_period_id, banner_id)
+                spend = metric_value_cached(spend_stats, mv_cache)["SPENT"]
 
                 delta = income - spend
 
                 parts_long.append(
-                    f"Δ(доход-расход) {fmt_int(delta)} ₽ {op_to_human(op)} {fmt_int(threshold)} ₽. "
-                    f"Доход: {period_to_label(period)}; Расход: {period_to_label(spend_period)}"
+                    f"Δ(доход-расход) {fmt_int(delta)} ₽ {op_h} {fmt_int(cond.value)} ₽. "
+                    f"Доход: {label(cond.period)}; Расход: {label(cond.spend_period)}"
                 )
-                parts_short.append(f"Δ {fmt_int(delta)} {op_to_human(op)} {fmt_int(threshold)}")
+                parts_short.append(f"Δ {fmt_int(delta)} {op_h} {fmt_int(cond.value)}")
 
             else:
                 # неизвестный режим
-                parts_long.append(f"Доход {income_i} ₽. {period_to_label(period)}")
+                parts_long.append(f"Доход {income_i} ₽. {label(cond.period)}")
                 parts_short.append(f"Доход {income_i}")
 
         elif ctype == "TARGET_ACTION":
-            target = (cond.get("target") or "").strip()
-            gid = int((banner_obj or {}).get("ad_group_id") or 0)
-            actual = banner_target_action_from_groups(gid, banner_objectives)
-
-            parts_long.append(f"Цель {actual} = {target}")
-            parts_short.append(f"TA {actual}")
+            parts_long.append(f"Цель {target_action} = {cond.target}")
+            parts_short.append(f"TA {target_action}")
 
     return "; ".join(parts_long).strip(), "; ".join(parts_short).strip()
 
-def eval_cost_rule(
-    rule: Dict[str, Any],
+def cost_rule_actual(
+    rule: CompiledCostRule,
     banner_id: int,
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-) -> Tuple[bool, str, str]:
-    if not isinstance(rule, dict):
-        return False, "", ""
-    if (rule.get("type") or "").upper() != "COST_RULE":
-        return False, "", ""
-
-    spent_rub = safe_float(rule.get("spentRub", 0))
-    metric = (rule.get("metric") or "").upper()
-    op = (rule.get("op") or "EQ").upper()
-    value = safe_float(rule.get("value", rule.get("valueRub", 0)))
-
-    period = rule.get("period") or {"type": "ALL_TIME"}
-    key = json.dumps(period, sort_keys=True, ensure_ascii=False)
-    stats = stats_by_period.get(key, {}).get(banner_id, {}) or {}
-    mv = metric_value_from_stats(stats)
-
-    if mv["SPENT"] < spent_rub:
-        return False, "", ""
-
-    if metric not in mv:
-        return False, "", ""
-
-    actual = float(mv[metric])
-    ok = op_compare(actual, op, value)
-    if not ok:
-        return False, "", ""
+    stats_by_period: StatsByPeriod,
+    mv_cache: Optional[MetricCache] = None,
+    mv: Optional[Dict[str, float]] = None,
+) -> Optional[float]:
+    """
+    Фактическое значение метрики, если COST_RULE срабатывает; None — не срабатывает.
+    mv — уже посчитанные метрики баннера за rule.period (если вызывающий их брал).
+    """
+    if rule.metric not in _METRIC_KEYS:
+        return None
+
+    if mv is None:
+        mv = metric_value_cached(get_stats(stats_by_period, rule.period_id, banner_id), mv_cache)
 
+    if mv["SPENT"] < rule.spent_rub:
+        return None
+
+    actual = float(mv[rule.metric])
+    if not rule.cmp(actual, rule.value):
+        return None
+    return actual
+
+
+def cost_rule_reason(rule: CompiledCostRule, actual: float, ctx: Optional[CheckContext] = None) -> Tuple[str, str]:
+    """(reason, short_reason) для сработавшего правила — форматируется только когда причина реально нужна."""
+    label = ctx.period_label if ctx is not None else period_to_label
+    metric_h = metric_to_human(rule.metric)
+    op_h = op_to_human(rule.op)
     reason = (
-        f"{metric_to_human(metric)} {op_to_human(op)} {fmt_int(value)} "
-        f"при расходе ≥ {fmt_int(spent_rub)}. {period_to_label(period)}."
+        f"{metric_h} {op_h} {fmt_int(rule.value)} "
+        f"при расходе ≥ {fmt_int(rule.spent_rub)}. {label(rule.period)}."
     )
     
     short_reason = (
-        f"{metric_to_human(metric)} {fmt_int(actual)} {op_to_human(op)} {fmt_int(value)}"
+        f"{metric_h} {fmt_int(actual)} {op_h} {fmt_int(rule.value)}"
     )
 
-    return True, reason, short_reason
+    return reason, short_reason
+
+
+def _result_cost_ok(rule: CompiledCostRule, mv: Dict[str, float]) -> bool:
+    """
+    Есть результаты и правило RESULT_COST НЕ срабатывает (цена результата в норме).
+    Например, op=GTE и actual < value — значит в норме.
+    """
+    return mv["RESULTS"] > 0 and not rule.cmp(mv["RESULT_COST"], rule.value)
 
 
 def eval_filter_node(
-    node: Dict[str, Any],
+    node: Optional[CompiledFilterNode],
     banner_id: int,
-    banner_obj: Dict[str, Any],
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-    income_store: IncomeStore,
-    banner_objectives: Dict[int, str],
+    stats_by_period: StatsByPeriod,
+    income_by_period: Dict[Tuple[str, int], Dict[int, float]],
+    target_action: str,
+    mv_cache: Optional[MetricCache] = None,
+    ctx: Optional[CheckContext] = None,
 ) -> Tuple[str, str, str, bool]:
     """
     Возвращает:
@@ -1056,167 +1785,154 @@ def eval_filter_node(
       matched_action: True если был "осознанно сматчен" action в этом узле (включая NOOP),
                       False если это просто "ничего не нашли" и нужно искать дальше по дереву/шаблонам.
     """
-    if not isinstance(node, dict):
-        return "NOOP", "", "", False
-
-    ntype = (node.get("type") or "").upper()
-
-    # Если вдруг в дереве встретится не FILTER — спускаемся в child (как и раньше)
-    if ntype != "FILTER":
-        child = node.get("child")
-        return eval_filter_node(child, banner_id, banner_obj, stats_by_period, income_store, banner_objectives)
+    # Идём по цепочке child циклом (без рекурсии на каждый уровень дерева)
+    while node is not None:
+        mode = node.mode
+        rules = node.rules
+
+        if node.conditions:
+            if not eval_conditions(node.conditions, banner_id, stats_by_period, income_by_period, target_action, mv_cache):
+                node = node.child
+                continue
 
-    mode = (node.get("mode") or "ALL").upper()
-    rules = node.get("rules") or []
-    if not isinstance(rules, list):
-        rules = []
-
-    conditions = node.get("conditions") or []
-    if isinstance(conditions, list) and conditions:
-        if not eval_conditions(conditions, banner_id, banner_obj, stats_by_period, income_store, banner_objectives):
-            child = node.get("child")
-            return eval_filter_node(child, banner_id, banner_obj, stats_by_period, income_store, banner_objectives)
-
-    # считаем срабатывания COST_RULE
-    # ВАЖНО: RESULT_COST имеет приоритет над CLICK_COST
-    # Если есть результаты и RESULT_COST НЕ нарушен (в норме) — CLICK_COST игнорируется
-    rule_hits: List[Tuple[bool, str, str]] = []
-    
-    # Проверяем, есть ли результаты и НЕ нарушено ли правило RESULT_COST
-    # (т.е. RESULT_COST в норме = правило RESULT_COST НЕ срабатывает)
-    result_cost_ok = False  # True = есть результаты и цена результата в норме
-    for r in rules:
-        if isinstance(r, dict) and (r.get("type") or "").upper() == "COST_RULE":
-            metric = (r.get("metric") or "").upper()
-            if metric in ("RESULT_COST", "CPA"):
-                period = r.get("period") or {"type": "ALL_TIME"}
-                key = json.dumps(period, sort_keys=True, ensure_ascii=False)
-                stats = stats_by_period.get(key, {}).get(banner_id, {}) or {}
-                mv = metric_value_from_stats(stats)
-                
-                # Если есть результаты (goals > 0)
-                if mv.get("RESULTS", 0) > 0:
-                    op = (r.get("op") or "EQ").upper()
-                    value = safe_float(r.get("value", r.get("valueRub", 0)))
-                    actual_result_cost = mv.get("RESULT_COST", 0)
-                    # Проверяем: правило RESULT_COST НЕ срабатывает? (цена в норме)
-                    # Если op=GTE и actual < value — значит в норме
-                    if not op_compare(actual_result_cost, op, value):
-                        result_cost_ok = True
-                break  # проверяем только первое RESULT_COST правило
-    
-    # Теперь оцениваем все правила с учётом приоритета RESULT_COST
-    for r in rules:
-        if isinstance(r, dict) and (r.get("type") or "").upper() == "COST_RULE":
-            metric = (r.get("metric") or "").upper()
-            # Если RESULT_COST в норме — CLICK_COST не должен срабатывать (принудительно False)
-            if result_cost_ok and metric in ("CLICK_COST", "CPC"):
-                rule_hits.append((False, "", ""))  # CLICK_COST игнорируется
+        # считаем срабатывания COST_RULE — за один проход по rules.
+        # ВАЖНО: RESULT_COST имеет приоритет над CLICK_COST
+        # Если есть результаты и RESULT_COST НЕ нарушен (в норме) — CLICK_COST игнорируется.
+        # Флаг известен, когда дошли до первого правила RESULT_COST (node.result_cost_rule);
+        # CLICK_COST-правила до него откладываем и досчитываем после цикла (порядок причин сохраняется).
+        # Ранний выход: в ANY решает первое срабатывание (берётся его причина),
+        # в ALL — первый промах (matched уже False, причины не нужны).
+        # В цикле копим только фактические значения сработавших правил (None — промах);
+        # строки причин форматируем после, и только если фильтр сматчен и у него есть action.
+        rc_rule = node.result_cost_rule
+        # True = есть результаты и цена результата в норме; None = ещё не дошли до RESULT_COST
+        result_cost_ok: Optional[bool] = None if rc_rule is not None else False
+        stop_on = mode == "ANY"
+        stopped = False
+        hits: List[Optional[float]] = []
+        deferred: List[int] = []
+        for r in rules:
+            if r is None:
+                # не COST_RULE — не срабатывает
+                actual = None
+            elif r.metric in ("CLICK_COST", "CPC") and result_cost_ok is not False:
+                if result_cost_ok:
+                    actual = None  # CLICK_COST игнорируется
+                else:
+                    deferred.append(len(hits))
+                    hits.append(None)
+                    continue
+            elif r is rc_rule:
+                mv = metric_value_cached(get_stats(stats_by_period, r.period_id, banner_id), mv_cache)
+                result_cost_ok = _result_cost_ok(r, mv)
+                actual = cost_rule_actual(r, banner_id, stats_by_period, mv_cache, mv=mv)
             else:
-                rule_hits.append(eval_cost_rule(r, banner_id, stats_by_period))
+                actual = cost_rule_actual(r, banner_id, stats_by_period, mv_cache)
+            hits.append(actual)
+            if (actual is not None) is stop_on:
+                stopped = True
+                break
+
+        # отложенные CLICK_COST нужны, только если ALL ещё не провален
+        if deferred and (stop_on or not stopped):
+            if result_cost_ok is None:
+                # вышли раньше, чем дошли до RESULT_COST — флаг считаем отдельно
+                result_cost_ok = _result_cost_ok(
+                    rc_rule, metric_value_cached(get_stats(stats_by_period, rc_rule.period_id, banner_id), mv_cache)
+                )
+            if not result_cost_ok:
+                for i in deferred:
+                    hits[i] = cost_rule_actual(rules[i], banner_id, stats_by_period, mv_cache)
+
+        # ВАЖНО:
+        # Если rules пустые, matched НЕ должен становиться True "сам по себе",
+        # иначе пустой FILTER с action:NOOP станет вечным стоп-краном.
+        if not rules:
+            matched = False
+        elif mode == "ANY":
+            matched = any(a is not None for a in hits)
         else:
-            rule_hits.append((False, "", ""))
+            matched = not stopped and all(a is not None for a in hits)
 
-    hit_bools = [x[0] for x in rule_hits]
+        if matched:
+            if node.action_state is None:
+                # если action невалидный/нет action — считаем, что решения нет
+                return "NOOP", "", "", False
 
-    # ВАЖНО:
-    # Если rules пустые, matched НЕ должен становиться True "сам по себе",
-    # иначе пустой FILTER с action:NOOP станет вечным стоп-краном.
-    if not hit_bools:
-        matched = False
-    elif mode == "ANY":
-        matched = any(hit_bools)
-    else:
-        matched = all(hit_bools)
+            fired = [(r, a) for r, a in zip(rules, hits) if a is not None]
+            if mode == "ANY":
+                # в ANY причина — первое сработавшее правило
+                fired = fired[:1]
+            texts = [cost_rule_reason(r, a, ctx) for r, a in fired]
+            reason = "; ".join(t[0] for t in texts)
+            short_reason = "; ".join(t[1] for t in texts)
 
-    if matched:
-        reasons = [x[1] for x in rule_hits if x[0] and x[1]]
-        short_reasons = [x[2] for x in rule_hits if x[0] and x[2]]
+            # matched_action=True => это осознанное решение (в т.ч. NOOP)
+            return node.action_state, reason, short_reason, True
 
-        if mode == "ANY":
-            reason = reasons[0] if reasons else ""
-            short_reason = short_reasons[0] if short_reasons else ""
-        else:
-            reason = "; ".join(reasons) if reasons else ""
-            short_reason = "; ".join(short_reasons) if short_reasons else ""
+        # если не matched — идём в child
+        node = node.child
 
-        action = node.get("action") or {}
-        if isinstance(action, dict) and (action.get("type") or "").upper() == "SET_STATE":
-            state = (action.get("state") or "NOOP").upper()
-            if state in ("DISABLE", "ENABLE", "NOOP"):
-                # matched_action=True => это осознанное решение (в т.ч. NOOP)
-                return state, reason, short_reason, True
+    return "NOOP", "", "", False
 
-        # если action невалидный/нет action — считаем, что решения нет
-        return "NOOP", "", "", False
 
-    # если не matched — идём в child
-    child = node.get("child")
-    return eval_filter_node(child, banner_id, banner_obj, stats_by_period, income_store, banner_objectives)
+def template_root(tpl: Dict[str, Any]) -> Any:
+    return tpl.get("root") if "root" in tpl else tpl.get("root", tpl.get("ROOT"))
+
+
+def order_templates_for_cabinet(templates: List[CompiledTemplate], cabinet_id: str) -> List[CompiledTemplate]:
+    """
+    Шаблоны, разрешённые для кабинета (accountsScope), по priority. Считается один раз на кабинет;
+    templates уже отсортированы в compile_templates — порядок просто сохраняем.
+    """
+    cabinet_id = str(cabinet_id)
+    return [tpl for tpl in templates if tpl.allowed_cabinets is None or cabinet_id in tpl.allowed_cabinets]
 
 
 def decide_action_for_banner(
-    templates: List[Dict[str, Any]],
-    cabinet_id: str,
+    ordered_templates: List[CompiledTemplate],
     banner_id: int,
-    banner_obj: Dict[str, Any],
-    stats_by_period: Dict[str, Dict[int, Dict[str, Any]]],
-    income_store: IncomeStore,
-    banner_objectives: Dict[int, str],
+    stats_by_period: StatsByPeriod,
+    income_by_period: Dict[Tuple[str, int], Dict[int, float]],
+    banner_ta: Dict[int, str],
+    ctx: Optional[CheckContext] = None,
 ) -> Tuple[str, str, str]:
-    ordered = sorted(
-        [t for t in templates if isinstance(t, dict)],
-        key=lambda x: int(x.get("priority", 9999) or 9999),
-    )
-
-    for tpl in ordered:
-        root = tpl.get("root") if "root" in tpl else tpl.get("root", tpl.get("ROOT"))
-        if not isinstance(root, dict):
-            continue
-
-        scope = root.get("accountsScope") or {}
-        if not accounts_scope_allows(scope, cabinet_id):
-            continue
-
+    """
+    ordered_templates — результат order_templates_for_cabinet (уже отфильтрованы и отсортированы).
+    ctx — контекст прогона (дата "сегодня" и кэш подписей периодов); без него берётся текущая дата.
+    """
+    # одни и те же stats баннера проверяются несколькими условиями/правилами — метрики считаем один раз
+    mv_cache: MetricCache = {}
+    # цель баннера тоже одна на все TARGET_ACTION-условия
+    target_action = banner_ta.get(banner_id, "APP")
+    for tpl in ordered_templates:
         # root conditions
-        conditions = root.get("conditions") or []
         root_reason = ""
         root_short = ""
 
-        if isinstance(conditions, list) and conditions:
-            if not eval_conditions(conditions, banner_id, banner_obj, stats_by_period, income_store, banner_objectives):
+        if tpl.has_conditions:
+            if not eval_conditions(tpl.check_conditions, banner_id, stats_by_period, income_by_period, target_action, mv_cache):
                 continue
 
             root_reason, root_short = conditions_to_reason(
-                conditions=conditions,
+                conditions=tpl.conditions,
                 banner_id=banner_id,
-                banner_obj=banner_obj,
                 stats_by_period=stats_by_period,
-                income_store=income_store,
-                banner_objectives=banner_objectives,
+                income_by_period=income_by_period,
+                target_action=target_action,
+                mv_cache=mv_cache,
+                ctx=ctx,
             )
 
-        child = root.get("child") or {}
-        root_conditions_passed = bool(isinstance(conditions, list) and conditions)
-        
-        if root_conditions_passed and isinstance(child, dict) and (child.get("type") or "").upper() == "FILTER":
-            rules0 = child.get("rules") or []
-            if not isinstance(rules0, list):
-                rules0 = []
-            action0 = child.get("action") or {}
-            if (not rules0) and isinstance(action0, dict) and (action0.get("type") or "").upper() == "SET_STATE":
-                direct_state = (action0.get("state") or "NOOP").upper()
-                if direct_state in ("DISABLE", "ENABLE", "NOOP"):
-                    reason = root_reason or "Условия ROOT выполнены"
-                    short_reason = root_short
-        
-                    tpl_name = str(tpl.get("name") or tpl.get("id") or "").strip()
-                    if tpl_name and reason:
-                        reason = f"[{tpl_name}] {reason}".strip()
-        
-                    return direct_state, reason, short_reason
+            # child-FILTER без rules, но с action — решение сразу по root conditions
+            if tpl.direct_state is not None:
+                reason = root_reason or "Условия ROOT выполнены"
+                if tpl.name and reason:
+                    reason = f"[{tpl.name}] {reason}".strip()
+                return tpl.direct_state, reason, root_short
+
         state, reason, short_reason, matched_action = eval_filter_node(
-            child, banner_id, banner_obj, stats_by_period, income_store, banner_objectives
+            tpl.child, banner_id, stats_by_period, income_by_period, target_action, mv_cache, ctx
         )
 
         # если фильтр реально принял решение (в т.ч. NOOP) — это терминально
@@ -1226,16 +1942,15 @@ def decide_action_for_banner(
             if not short_reason and root_short:
                 short_reason = root_short
 
-            tpl_name = str(tpl.get("name") or tpl.get("id") or "").strip()
-            if tpl_name and reason:
-                reason = f"[{tpl_name}] {reason}".strip()
+            if tpl.name and reason:
+                reason = f"[{tpl.name}] {reason}".strip()
 
             # ВАЖНО: state=NOOP => "не трогать", т.е. останавливаемся и не даём нижним приоритетам трогать
-            if state.upper() == "NOOP":
+            if state == "NOOP":
                 return "NOOP", reason, short_reason
 
-            if state.upper() in ("DISABLE", "ENABLE"):
-                return state.upper(), reason, short_reason
+            if state in ("DISABLE", "ENABLE"):
+                return state, reason, short_reason
 
             # на всякий случай
             return "NOOP", reason, short_reason
@@ -1248,61 +1963,115 @@ def decide_action_for_banner(
 # ============================================================
 # disabled_banners.json per cabinet
 # ============================================================
-def disabled_file_path(users_root: str, tg_id: str, cabinet_id: str) -> pathlib.Path:
+@dataclass(frozen=True)
+class CabinetPaths:
+    """Файлы кабинета users/<tg_id>/<cabinet_id>/..."""
+    __slots__ = ("root", "disabled", "enabled", "history", "notify_state", "objectives_cache")
+
+    root: pathlib.Path
+    disabled: pathlib.Path
+    enabled: pathlib.Path
+    history: pathlib.Path
+    notify_state: pathlib.Path
+    objectives_cache: pathlib.Path
+
+
+@lru_cache(maxsize=None)
+def cabinet_paths(users_root: str, tg_id: str, cabinet_id: str) -> CabinetPaths:
+    """Пути собираются, каталог создаётся и старая history переносится в JSONL один раз на кабинет."""
     p = pathlib.Path(users_root) / str(tg_id) / str(cabinet_id)
     ensure_dir(p)
-    return p / "disabled_banners.json"
+    paths = CabinetPaths(
+        root=p,
+        disabled=p / "disabled_banners.json",
+        enabled=p / "enabled_banners.json",
+        history=p / "history_banners.jsonl",
+        notify_state=p / "notify_state.json",
+        objectives_cache=p / "objectives_cache.json",
+    )
+    migrate_history_to_jsonl(p / "history_banners.json", paths.history)
+    return paths
 
-def enabled_file_path(users_root: str, tg_id: str, cabinet_id: str) -> pathlib.Path:
-    p = pathlib.Path(users_root) / str(tg_id) / str(cabinet_id)
-    ensure_dir(p)
-    return p / "enabled_banners.json"
 
+def load_objectives_cache(path: pathlib.Path) -> Dict[int, Tuple[str, float]]:
+    """{"<group_id>": {"objective": "...", "ts": unix_time}} -> {group_id: (objective, ts)}"""
+    if not path.exists():
+        return {}
+    try:
+        data = json.loads(path.read_bytes())
+        out: Dict[int, Tuple[str, float]] = {}
+        if isinstance(data, dict):
+            for k, v in data.items():
+                if not isinstance(v, dict):
+                    continue
+                try:
+                    out[int(k)] = (str(v.get("objective") or ""), float(v.get("ts") or 0))
+                except Exception:
+                    continue
+        return out
+    except Exception as e:
+        logger.error(f"Ошибка чтения {path}: {e}")
+        return {}
+
+
+def save_objectives_cache(path: pathlib.Path, cache: Dict[int, Tuple[str, float]]) -> None:
+    try:
+        data = {str(gid): {"objective": obj, "ts": ts} for gid, (obj, ts) in cache.items()}
+        atomic_write_text(path, _JSON_LINE.encode(data))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения {path}: {e}")
+
+
+def migrate_history_to_jsonl(legacy_path: pathlib.Path, path: pathlib.Path) -> None:
+    """
+    Старый history_banners.json (JSON-массив) -> history_banners.jsonl (по записи на строку).
+    Старые записи ставятся перед уже имеющимися в .jsonl, старый файл переименовывается в .bak.
+    """
+    if not legacy_path.exists():
+        return
+    try:
+        raw = json.loads(legacy_path.read_bytes())
+        records = [x for x in raw if isinstance(x, dict)] if isinstance(raw, list) else []
+
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write("".join(_JSON_LINE.encode(rec) + "\n" for rec in records).encode("utf-8"))
+            if path.exists():
+                # уже имеющийся .jsonl копируем байтами крупными блоками — без декодирования по строкам
+                with open(path, "rb") as cur:
+                    shutil.copyfileobj(cur, f, 1024 * 1024)
+        os.replace(tmp, path)
+        os.replace(legacy_path, legacy_path.with_name(legacy_path.name + ".bak"))
+        logger.info(f"🧾 history перенесена в JSONL: {path} (records={len(records)})")
+    except Exception as e:
+        logger.error(f"Ошибка миграции history {legacy_path}: {e}")
 
-def history_file_path(users_root: str, tg_id: str, cabinet_id: str) -> pathlib.Path:
-    p = pathlib.Path(users_root) / str(tg_id) / str(cabinet_id)
-    ensure_dir(p)
-    return p / "history_banners.json"
 
 def append_history(path: pathlib.Path, record: Dict[str, str]) -> None:
+    # JSONL: дописываем одну строку, не перечитывая и не переписывая весь файл
     try:
-        data: List[Dict[str, str]] = []
-        if path.exists():
-            with open(path, "r", encoding="utf-8") as f:
-                raw = json.load(f)
-            if isinstance(raw, list):
-                data = [x for x in raw if isinstance(x, dict)]
-        data.append(record)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(_JSON_LINE.encode(record) + "\n")
     except Exception as e:
         logger.error(f"Ошибка записи history {path}: {e}")
 
-def notify_state_path(users_root: str, tg_id: str, cabinet_id: str) -> pathlib.Path:
-    p = pathlib.Path(users_root) / str(tg_id) / str(cabinet_id)
-    ensure_dir(p)
-    return p / "notify_state.json"
-
 
 def load_last_notify_utc(path: pathlib.Path) -> Optional[dt.datetime]:
     if not path.exists():
         return None
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f) or {}
+        data = json.loads(path.read_bytes()) or {}
         s = str(data.get("last_notify_utc") or "").strip()
         if not s:
             return None
-        return dt.datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
+        return parse_ymd_hms(s)
     except Exception:
         return None
 
 
 def save_last_notify_utc(path: pathlib.Path, when_utc: dt.datetime) -> None:
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump({"last_notify_utc": when_utc.strftime("%Y-%m-%d %H:%M:%S")},
-                      f, ensure_ascii=False, indent=2)
+        atomic_write_text(path, _JSON_PRETTY.encode({"last_notify_utc": when_utc.isoformat(sep=" ", timespec="seconds")}))
     except Exception as e:
         logger.error(f"Ошибка записи notify_state {path}: {e}")
 
@@ -1310,33 +2079,78 @@ def save_last_notify_utc(path: pathlib.Path, when_utc: dt.datetime) -> None:
 def parse_history_daytime_to_utc(daytime_str: str) -> Optional[dt.datetime]:
     # history хранит daytime в UTC+4
     try:
-        local_dt = dt.datetime.strptime(daytime_str, "%Y-%m-%d %H:%M:%S")
+        local_dt = parse_ymd_hms(daytime_str)
         return local_dt - dt.timedelta(hours=4)
     except Exception:
         return None
 
 
-def read_history_events_since(history_path: pathlib.Path, since_utc: Optional[dt.datetime]) -> List[Dict[str, Any]]:
+def _iter_lines_reversed(path: pathlib.Path, block_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Строки файла с конца к началу (читаем блоками с хвоста, без загрузки всего файла)."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            # первая строка блока может быть неполной — доклеим к ней следующий (более ранний) блок
+            tail = lines[0]
+            for line in reversed(lines[1:]):
+                yield line
+        yield tail
+
+
+def _history_event(line: bytes) -> Optional[Tuple[Dict[str, Any], dt.datetime]]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        item = json.loads(line)
+    except Exception:
+        return None
+    if not isinstance(item, dict):
+        return None
+    s = str(item.get("daytime") or "").strip()
+    if not s:
+        return None
+    t_utc = parse_history_daytime_to_utc(s)
+    if not t_utc:
+        return None
+    return item, t_utc
+
+
+def read_history_events_since(
+    history_path: pathlib.Path, since_utc: Optional[dt.datetime]
+) -> List[Tuple[dt.datetime, Dict[str, Any]]]:
+    """
+    События history новее since_utc, в порядке записи: (время UTC, запись) — daytime уже разобран,
+    повторно его не парсим.
+    history — append-only JSONL, daytime не убывает, поэтому при since_utc читаем файл с конца
+    и останавливаемся на первом событии не новее since_utc.
+    """
     if not history_path.exists():
         return []
     try:
-        with open(history_path, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-        if not isinstance(raw, list):
-            return []
+        out: List[Tuple[dt.datetime, Dict[str, Any]]] = []
+        if since_utc is None:
+            with open(history_path, "rb") as f:
+                for line in f:
+                    ev = _history_event(line)
+                    if ev is not None:
+                        out.append((ev[1], ev[0]))
+            return out
 
-        out: List[Dict[str, Any]] = []
-        for item in raw:
-            if not isinstance(item, dict):
-                continue
-            s = str(item.get("daytime") or "").strip()
-            if not s:
+        for line in _iter_lines_reversed(history_path):
+            ev = _history_event(line)
+            if ev is None:
                 continue
-            t_utc = parse_history_daytime_to_utc(s)
-            if not t_utc:
-                continue
-            if since_utc is None or t_utc > since_utc:
-                out.append(item)
+            if ev[1] <= since_utc:
+                break
+            out.append((ev[1], ev[0]))
+        out.reverse()
         return out
     except Exception as e:
         logger.error(f"Ошибка чтения history {history_path}: {e}")
@@ -1356,51 +2170,124 @@ def is_due_to_send(last_notify_utc: Optional[dt.datetime], every_min: Optional[i
     return (now_utc - last_notify_utc).total_seconds() >= int(every_min) * 60
 
 
-def reduce_latest_per_banner(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def reduce_latest_per_banner(events: List[Tuple[dt.datetime, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Последнее событие по каждому баннеру, по времени. events — из read_history_events_since,
+    уже в порядке записи (= по времени), поэтому вместо сортировки держим порядок вставки:
+    повторное событие баннера переносим в конец dict'а.
+    """
     last: Dict[str, Dict[str, Any]] = {}
-    for e in events:
+    for _, e in events:
         bid = str(e.get("id_banner") or "").strip()
         if bid:
+            last.pop(bid, None)
             last[bid] = e
 
-    def event_utc(e: Dict[str, Any]) -> float:
-        t = parse_history_daytime_to_utc(str(e.get("daytime") or ""))
-        return t.timestamp() if t else 0.0
+    return list(last.values())
+
+def _record_value(v: Any) -> str:
+    # большинство значений уже строки — str() зовём только для остальных
+    if isinstance(v, str):
+        return v
+    return "" if v is None else str(v)
+
+
+@dataclass
+class BannerRecord:
+    """
+    Запись disabled_banners.json / enabled_banners.json, созданная в этом прогоне (без dict на каждый баннер).
+    Записи, прочитанные из файла, остаются dict'ами (см. _stored_record) — пишутся обратно без потерь.
+    """
+    __slots__ = (
+        "daytime",
+        "id_banner",
+        "name_banner",
+        "url",
+        "reason",
+        "short_reason",
+        "status",
+        "checker_enabled",
+        "income",
+        "spent_all_time",
+        "goals_all_time",
+        "cpa_all_time",
+        "clicks_all_time",
+        "cpc_all_time",
+    )
+
+    daytime: str
+    id_banner: str
+    name_banner: str
+    url: str
+    reason: str
+    short_reason: str
+    status: str
+    checker_enabled: str
+    income: str
+    spent_all_time: str
+    goals_all_time: str
+    cpa_all_time: str
+    clicks_all_time: str
+    cpc_all_time: str
+
+    def to_dict(self) -> Dict[str, str]:
+        return {k: getattr(self, k) for k in _BANNER_RECORD_FIELDS}
+
+
+_BANNER_RECORD_FIELDS: Tuple[str, ...] = tuple(f.name for f in fields(BannerRecord))
+
+# запись из файла (dict) или новая запись прогона (BannerRecord)
+StoredRecord = Union[BannerRecord, Dict[str, str]]
+
+# значения этих полей повторяются у множества записей — храним по одной копии строки
+_INTERNED_RECORD_KEYS = frozenset({"reason", "short_reason", "status", "checker_enabled"})
+
+
+def _stored_record(item: Dict[Any, Any]) -> Dict[str, str]:
+    """Запись из файла как есть: все ключи (и незнакомые тоже), значения строками."""
+    out: Dict[str, str] = {}
+    for k, v in item.items():
+        k = str(k)
+        v = _record_value(v)
+        if k in _INTERNED_RECORD_KEYS:
+            v = sys.intern(v)
+        out[k] = v
+    return out
 
-    return sorted(last.values(), key=event_utc)
 
-def load_disabled_records(path: pathlib.Path) -> Dict[str, Dict[str, str]]:
+def load_disabled_records(path: pathlib.Path) -> Dict[str, StoredRecord]:
     if not path.exists():
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        # один read + один разбор (ключи JSON-объекта и так строки)
+        data = json.loads(path.read_bytes())
         if isinstance(data, dict):
-            out: Dict[str, Dict[str, str]] = {}
+            out: Dict[str, StoredRecord] = {}
             for k, v in data.items():
                 if isinstance(v, dict):
-                    out[str(k)] = {str(kk): "" if vv is None else str(vv) for kk, vv in v.items()}
+                    out[k] = _stored_record(v)
             return out
         if isinstance(data, list):
-            out2: Dict[str, Dict[str, str]] = {}
+            out2: Dict[str, StoredRecord] = {}
             for item in data:
                 if not isinstance(item, dict):
                     continue
                 bid = str(item.get("id_banner", "")).strip()
                 if not bid:
                     continue
-                out2[bid] = {str(k): "" if v is None else str(v) for k, v in item.items()}
+                out2[bid] = _stored_record(item)
             return out2
     except Exception as e:
         logger.error(f"Ошибка чтения {path}: {e}")
     return {}
 
 
-def save_disabled_records(path: pathlib.Path, records: Dict[str, Dict[str, str]]) -> None:
+def save_disabled_records(path: pathlib.Path, records: Dict[str, StoredRecord]) -> None:
     try:
-        arr = list(records.values())
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(arr, f, ensure_ascii=False, indent=2)
+        # новые записи переводим в dict только при записи, прочитанные из файла уже dict
+        arr = [rec.to_dict() if isinstance(rec, BannerRecord) else rec for rec in records.values()]
+        # сериализуем целиком и пишем одним write (атомарно), а не кусками через json.dump
+        atomic_write_text(path, _JSON_PRETTY.encode(arr))
     except Exception as e:
         logger.error(f"Ошибка сохранения {path}: {e}")
 
@@ -1416,24 +2303,28 @@ def make_banner_record(
     reason: str,
     short_reason: str,
     income: float,
-) -> Dict[str, str]:
-    mv = metric_value_from_stats(stats_all_time or {})
-    return {
-        "daytime": now_str(),
-        "id_banner": str(banner_id),
-        "name_banner": name or "",
-        "url": url or "",
-        "reason": reason or "",
-        "short_reason": short_reason or "",
-        "status": status,
-        "checker_enabled": checker_enabled,
-        "income": fmt_int(income),
-        "spent_all_time": fmt_int(mv["SPENT"]),
-        "goals_all_time": fmt_int(mv["RESULTS"]),
-        "cpa_all_time": fmt_int(mv["RESULT_COST"]),
-        "clicks_all_time": fmt_int(mv["CLICKS"]),
-        "cpc_all_time": fmt_int(mv["CLICK_COST"]),
-    }
+    mv: Optional[Dict[str, float]] = None,
+) -> BannerRecord:
+    # mv — уже посчитанные метрики ALL_TIME (если вызывающий их имеет)
+    if mv is None:
+        mv = metric_value_from_stats(stats_all_time or {})
+    fi = fmt_int
+    return BannerRecord(
+        daytime=now_str(),
+        id_banner=str(banner_id),
+        name_banner=name or "",
+        url=url or "",
+        reason=sys.intern(reason or ""),
+        short_reason=sys.intern(short_reason or ""),
+        status=status,
+        checker_enabled=checker_enabled,
+        income=fi(income),
+        spent_all_time=fi(mv["SPENT"]),
+        goals_all_time=fi(mv["RESULTS"]),
+        cpa_all_time=fi(mv["RESULT_COST"]),
+        clicks_all_time=fi(mv["CLICKS"]),
+        cpc_all_time=fi(mv["CLICK_COST"]),
+    )
 
 # ============================================================
 # User config + settings loader
@@ -1442,8 +2333,7 @@ def load_user_config(users_root: str, tg_id: str) -> Dict[str, Any]:
     path = pathlib.Path(users_root) / str(tg_id) / f"{tg_id}.json"
     if not path.exists():
         raise FileNotFoundError(f"Не найден файл пользователя: {path}")
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = json.loads(path.read_bytes())
     if not isinstance(data, dict):
         raise ValueError(f"Некорректный формат {path}: ожидался JSON object")
     return data
@@ -1454,8 +2344,7 @@ def load_user_settings(users_root: str, tg_id: str) -> Dict[str, Any]:
     if not path.exists():
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = json.loads(path.read_bytes())
         if isinstance(data, dict):
             return data
     except Exception as e:
@@ -1469,8 +2358,7 @@ def load_user_filters(users_root: str, tg_id: str) -> List[Dict[str, Any]]:
         logger.warning(f"⚠️ Не найден filters.json: {path} — действий не будет")
         return []
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = json.loads(path.read_bytes())
         tpls = extract_templates(data)
         logger.info(f"✅ Загружены фильтры: templates={len(tpls)} из {path}")
         return tpls
@@ -1492,8 +2380,7 @@ def load_user_listfile(users_root: str, tg_id: str, filename: str) -> Dict[str,
     if not path.exists():
         return {"campaign_ids": [], "banner_ids": []}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = json.loads(path.read_bytes())
         if not isinstance(data, dict):
             return {"campaign_ids": [], "banner_ids": []}
         cids = data.get("campaign_ids") or []
@@ -1510,54 +2397,54 @@ def load_user_listfile(users_root: str, tg_id: str, filename: str) -> Dict[str,
         logger.error(f"Ошибка чтения {path}: {e}")
         return {"campaign_ids": [], "banner_ids": []}
 
+def _to_int_set(xs: Iterable[Any]) -> set[int]:
+    """id из white/black list: числа берём как есть, строки — только из цифр (как str(x).isdigit())."""
+    out: set[int] = set()
+    for x in xs:
+        t = type(x)
+        if t is int:
+            if x >= 0:
+                out.add(x)
+        elif t is str and x.isdigit():
+            out.add(int(x))
+    return out
+
+
 def discover_users(users_root: str) -> List[str]:
-    p = pathlib.Path(users_root)
-    if not p.exists():
+    if not os.path.isdir(users_root):
         return []
-    out: List[str] = []
-    for child in p.iterdir():
-        if child.is_dir():
-            out.append(child.name)
-    return sorted(out)
+    # scandir отдаёт тип записи из самого чтения каталога — без stat на каждого пользователя
+    with os.scandir(users_root) as it:
+        return sorted(e.name for e in it if e.is_dir())
 
 
 # ============================================================
 # Сбор периодов из filters.json
 # ============================================================
 def collect_periods_from_filters(templates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    periods: List[Dict[str, Any]] = [{"type": "ALL_TIME"}]
-
-    def add_period(p: Any) -> None:
-        if not isinstance(p, dict):
-            return
-        if "type" not in p:
-            return
-        periods.append({"type": p.get("type"), "n": p.get("n")})
-
-    def walk_node(obj: Any) -> None:
+    # ALL_TIME нужен всегда; явный ALL_TIME в фильтрах второй раз не добавляем
+    periods: List[Dict[str, Any]] = [{"type": "ALL_TIME", "n": None}]
+    seen: set[Tuple[Any, Any]] = {("ALL_TIME", None)}
+
+    # обход без рекурсии: явный стек + дедуп по (type, n) сразу при сборе
+    stack: List[Any] = [templates]
+    while stack:
+        obj = stack.pop()
         if isinstance(obj, dict):
-            # обычные period
-            if "period" in obj:
-                add_period(obj.get("period"))
-
-            # ВАЖНО: spendPeriod для COMPARE_SPEND
-            if "spendPeriod" in obj:
-                add_period(obj.get("spendPeriod"))
-
-            for v in obj.values():
-                walk_node(v)
+            # обычные period + ВАЖНО: spendPeriod для COMPARE_SPEND
+            for k in ("period", "spendPeriod"):
+                p = obj.get(k)
+                if isinstance(p, dict) and "type" in p:
+                    key = (p.get("type"), p.get("n"))
+                    if key not in seen:
+                        seen.add(key)
+                        periods.append({"type": key[0], "n": key[1]})
+            # reversed — чтобы порядок обхода (и порядок периодов) был как при рекурсии
+            stack.extend(reversed(list(obj.values())))
         elif isinstance(obj, list):
-            for it in obj:
-                walk_node(it)
-
-    walk_node(templates)
-
-    uniq: Dict[str, Dict[str, Any]] = {}
-    for p in periods:
-        key = json.dumps(p, sort_keys=True, ensure_ascii=False)
-        uniq[key] = p
+            stack.extend(reversed(obj))
 
-    return list(uniq.values())
+    return periods
 
 
 # ============================================================
@@ -1567,15 +2454,16 @@ def build_stats_cache(
     api: VkAdsApi,
     banner_ids: List[int],
     periods: List[Dict[str, Any]],
-) -> Dict[str, Dict[int, Dict[str, Any]]]:
+    today: Optional[dt.date] = None,
+) -> StatsByPeriod:
 
-    out: Dict[str, Dict[int, Dict[str, Any]]] = {}
-
-    for period in periods:
-        key = json.dumps(period, sort_keys=True, ensure_ascii=False)
-        out[key] = {}
+    out: StatsByPeriod = {}
+    if not periods:
+        return out
 
-        dr = daterange_from_period(period)
+    def fetch_period(period: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+        by_banner: Dict[int, Dict[str, Any]] = {}
+        dr = daterange_from_period(period, today)
 
         for chunk in chunked(banner_ids, 200):
             if dr is None:
@@ -1585,21 +2473,61 @@ def build_stats_cache(
                 part = api.stats_day_banners(chunk, date_from, date_to)
 
             # аккуратно мержим
-            out[key].update(part)
+            by_banner.update(part)
+        return by_banner
+
+    # периоды независимы — запрашиваем их параллельно
+    with ThreadPoolExecutor(max_workers=min(STATS_PERIOD_WORKERS, len(periods))) as ex:
+        parts = list(ex.map(fetch_period, periods))
 
+    for period, part in zip(periods, parts):
+        out[period_id(period)] = part
+
+    return out
+
+
+def build_income_cache(
+    income_store: IncomeStore,
+    banner_ids: List[int],
+    periods: List[Dict[str, Any]],
+    today: Optional[dt.date] = None,
+) -> Dict[Tuple[str, int], Dict[int, float]]:
+    """Доход по всем баннерам кабинета для каждого периода из filters.json: period_key -> {banner_id: income}."""
+    out: Dict[Tuple[str, int], Dict[int, float]] = {}
+    for period in periods:
+        key = income_period_key(period)
+        if key not in out:
+            out[key] = income_store.income_for_period_bulk(banner_ids, period, today)
     return out
 
 
 # ============================================================
 # Processing one cabinet
 # ============================================================
+# строки TG-уведомления по баннеру (шаблоны постоянные — %-подстановка)
+_TG_OFF_ITEM = (
+    "<b>%s</b> #%s\n"
+    "    ⤷ Причина: %s\n"
+    "    ⤷ Потрачено: %s ₽\n"
+    "    ⤷ Результат: %s | %s ₽"
+)
+_TG_ON_ITEM = (
+    "<b>%s</b> #%s\n"
+    "    ⤷ Причина: %s\n"
+    "    ⤷ Доход: %s ₽\n"
+    "    ⤷ Потрачено: %s ₽\n"
+    "    ⤷ Результат: %s | %s ₽"
+)
+
+
 def process_cabinet(
     *,
     users_root: str,
     tg_id: str,
     chat_id: Optional[str],
     tg_bot_token: Optional[str],
-    templates: List[Dict[str, Any]],
+    templates: List[CompiledTemplate],
+    periods: List[Dict[str, Any]],
     income_store: IncomeStore,
     cabinet: Dict[str, Any],
     dry_run: bool,
@@ -1636,44 +2564,63 @@ def process_cabinet(
         logger.warning(f"[{tg_id}] Пропуск кабинета: не хватает id/token. cabinet={cabinet}")
         return
 
-    logger.info("=" * 80)
-    logger.info(f"[USER {tg_id}] CABINET: {cabinet_name} (id={cabinet_id}) | ignore_manual_enabled_ads={ignore_manual_enabled_ads}")
+    # у каждого кабинета свой префикс в логе — кабинеты пишут в лог одновременно
+    log = CabinetLogAdapter(logger, cabinet_id)
+    log.info("=" * 80)
+    log.info(f"[USER {tg_id}] CABINET: {cabinet_name} (id={cabinet_id}) | ignore_manual_enabled_ads={ignore_manual_enabled_ads}")
 
-    api = VkAdsApi(token=token, base_url=BASE_URL, dry_run=dry_run)
+    paths = cabinet_paths(users_root, str(tg_id), str(cabinet_id))
+
+    api = VkAdsApi(
+        token=token,
+        base_url=BASE_URL,
+        dry_run=dry_run,
+        objectives_cache_path=paths.objectives_cache,
+        log=log,
+    )
 
-    active_banners = api.list_banners_by_status("active")
-    blocked_banners = api.list_banners_by_status("blocked")
+    # active и blocked независимы — забираем одновременно
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        active_fut = ex.submit(api.list_banners_by_status, "active")
+        blocked_fut = ex.submit(api.list_banners_by_status, "blocked")
+        active_banners = active_fut.result()
+        blocked_banners = blocked_fut.result()
 
-    active_ids = [int(b.get("id")) for b in active_banners if b.get("id") is not None]
-    blocked_ids = [int(b.get("id")) for b in blocked_banners if b.get("id") is not None]
+    # id читаем один раз на баннер
+    active_ids = [int(i) for b in active_banners if (i := b.get("id")) is not None]
+    blocked_ids = [int(i) for b in blocked_banners if (i := b.get("id")) is not None]
 
-    all_ids = sorted(set(active_ids + blocked_ids))
+    all_ids = sorted({*active_ids, *blocked_ids})
     if not all_ids:
-        logger.info("Баннеров не найдено")
+        log.info("Баннеров не найдено")
         return
 
-    api.fetch_banners_info(all_ids, fields="created,name,content,ad_group_id")
     # --- WHITE / BLACK LIST ---
-    white_campaign_ids = [int(x) for x in (white_list.get("campaign_ids") or []) if str(x).isdigit()]
-    white_banner_ids_direct = [int(x) for x in (white_list.get("banner_ids") or []) if str(x).isdigit()]
+    white_campaign_ids = _to_int_set(white_list.get("campaign_ids") or [])
+    white_banner_ids_direct = _to_int_set(white_list.get("banner_ids") or [])
     
-    black_campaign_ids = [int(x) for x in (black_list.get("campaign_ids") or []) if str(x).isdigit()]
-    black_banner_ids_direct = [int(x) for x in (black_list.get("banner_ids") or []) if str(x).isdigit()]
+    black_campaign_ids = _to_int_set(black_list.get("campaign_ids") or [])
+    black_banner_ids_direct = _to_int_set(black_list.get("banner_ids") or [])
     
     whitelist_set: Optional[set[int]] = None
-    blacklist_set: set[int] = set(black_banner_ids_direct)
-    
-    # black campaigns -> group ids -> banners
-    if black_campaign_ids:
-        g_ids_black = api.fetch_group_ids_from_campaigns(black_campaign_ids)
-        b_ids_black = api.fetch_banner_ids_from_groups(g_ids_black)
-        blacklist_set.update(b_ids_black)
-    
-    # white campaigns -> group ids -> banners
-    if white_campaign_ids:
-        g_ids_white = api.fetch_group_ids_from_campaigns(white_campaign_ids)
-        b_ids_white = api.fetch_banner_ids_from_groups(g_ids_white)
-        whitelist_set = set(b_ids_white)
+    blacklist_set: set[int] = black_banner_ids_direct
+
+    def campaign_banner_ids(campaign_ids: Iterable[int]) -> List[int]:
+        # campaigns -> group ids -> banners
+        return api.fetch_banner_ids_from_groups(api.fetch_group_ids_from_campaigns(campaign_ids))
+
+    # метаданные баннеров и разворот white/black кампаний друг от друга не зависят —
+    # запросы идут параллельно (banner_info_cache пишет только fetch_banners_info)
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        info_fut = ex.submit(api.fetch_banners_info, all_ids, fields="created,name,content,ad_group_id")
+        black_fut = ex.submit(campaign_banner_ids, black_campaign_ids) if black_campaign_ids else None
+        white_fut = ex.submit(campaign_banner_ids, white_campaign_ids) if white_campaign_ids else None
+        info_fut.result()
+
+        if black_fut is not None:
+            blacklist_set.update(black_fut.result())
+        if white_fut is not None:
+            whitelist_set = set(white_fut.result())
     
     # white direct banners добавляем
     if white_banner_ids_direct:
@@ -1683,48 +2630,41 @@ def process_cabinet(
     
     # Если whitelist существует, но пустой — тогда просто "ничего не трогать"
     if whitelist_set is not None and len(whitelist_set) == 0:
-        logger.info("WHITE_LIST задан, но пустой => не трогаем ничего")
+        log.info("WHITE_LIST задан, но пустой => не трогаем ничего")
         return
     # Важно: цель (TARGET_ACTION) берём по ad_groups objective
-    group_ids: List[int] = []
+    # bid -> ad_group_id разбираем один раз (0 — группы нет / не число)
+    gid_by_bid: Dict[int, int] = {}
     for bid in all_ids:
-        info = api.banner_info_cache.get(bid, {}) or {}
-        gid = info.get("ad_group_id")
+        gid = (api.banner_info_cache.get(bid) or {}).get("ad_group_id")
         try:
-            if gid is not None:
-                group_ids.append(int(gid))
+            gid_by_bid[bid] = int(gid or 0)
         except Exception:
-            pass
-        
-    group_objectives = api.build_groups_objective_cache(group_ids)
-
-    periods = collect_periods_from_filters(templates)
-    stats_by_period = build_stats_cache(api, all_ids, periods)
-    stats_all_key = json.dumps({"type": "ALL_TIME"}, sort_keys=True, ensure_ascii=False)
-    stats_all_map = stats_by_period.get(stats_all_key, {}) or {}
-
-    dis_path = disabled_file_path(users_root, tg_id, cabinet_id)
+            gid_by_bid[bid] = 0
+
+    group_objectives = api.build_groups_objective_cache(list(gid_by_bid.values()))
+    # target_action не меняется в рамках прогона — считаем один раз на группу, баннеру достаётся готовая строка
+    group_ta: Dict[int, str] = {gid: objective_to_target_action(obj) for gid, obj in group_objectives.items()}
+    banner_ta: Dict[int, str] = {bid: group_ta.get(gid, "APP") for bid, gid in gid_by_bid.items()}
+
+    ordered_templates = order_templates_for_cabinet(templates, cabinet_id)
+    # одна дата на весь прогон кабинета: статистика, доходы и подписи периодов
+    ctx = CheckContext()
+    stats_by_period = build_stats_cache(api, all_ids, periods, ctx.today)
+    income_by_period = build_income_cache(income_store, all_ids, periods, ctx.today)
+    stats_all_map = stats_by_period.get(ALL_TIME_ID) or _EMPTY_STATS
+    income_all_map = income_by_period[INCOME_ALL_TIME_KEY]
+    # метрики ALL_TIME, уже посчитанные в проверке spent_all_time — переиспользуем в записях
+    mv_all_map: Dict[int, Dict[str, float]] = {}
+
+    dis_path = paths.disabled
     disabled_records = load_disabled_records(dis_path)
 
-    en_path = enabled_file_path(users_root, tg_id, cabinet_id)
+    en_path = paths.enabled
     enabled_records = load_disabled_records(en_path)
 
-    his_path = history_file_path(users_root, tg_id, cabinet_id)
-    
-    active_by_id: Dict[int, Dict[str, Any]] = {}
-    blocked_by_id: Dict[int, Dict[str, Any]] = {}
-    for b in active_banners:
-        try:
-            active_by_id[int(b.get("id"))] = b
-        except Exception:
-            pass
-    for b in blocked_banners:
-        try:
-            blocked_by_id[int(b.get("id"))] = b
-        except Exception:
-            pass
+    his_path = paths.history
 
-    disabled_count = 0
     effective_max_disables = max_disables
     if limit_disabled_banners_20:
         effective_max_disables = min(int(max_disables), 20)
@@ -1732,70 +2672,95 @@ def process_cabinet(
         effective_max_disables = 10**9
     notify_disabled: List[str] = []
     notify_enabled: List[str] = []
+    # логи пропусков пишутся на каждый баннер — проверяем уровень один раз на кабинет
+    log_info = log.isEnabledFor(logging.INFO)
+    # white/black list сводим в одно множество исключённых заранее — в циклах одна проверка на баннер
+    list_excluded: set[int] = blacklist_set.copy()
+    if whitelist_set is not None:
+        list_excluded |= set(all_ids) - whitelist_set
+
+    # 1) DISABLE для активных: сначала решаем, потом отключаем пачкой.
+    # Лимит считаем по реально отключённым: если часть пачки не отключилась, добираем следующими баннерами.
+    to_disable: List[Tuple[int, str, str]] = []
+    disabled_ok: set[int] = set()
+    sent = 0  # сколько из to_disable уже отправлено в VK
+
+    def send_pending() -> None:
+        nonlocal sent
+        if sent < len(to_disable):
+            disabled_ok.update(api.disable_banners_bulk([bid for bid, _, _ in to_disable[sent:]]))
+            sent = len(to_disable)
 
-    # 1) DISABLE для активных
     for bid in active_ids:
         if ignore_manual_enabled_ads and str(bid) in disabled_records:
-            logger.info(f"▶ Пропускаем баннер {bid}: already in disabled_banners.json и ignore_manual_enabled_ads=true")
+            if log_info:
+                log.info("▶ Пропускаем баннер %s: already in disabled_banners.json и ignore_manual_enabled_ads=true", bid)
             continue
             
         # --- whitelist/blacklist ---
-        if whitelist_set is not None and bid not in whitelist_set:
-            logger.info(f"▶ Пропускаем баннер {bid}: не в white_list")
-            continue
-        if bid in blacklist_set:
-            logger.info(f"▶ Пропускаем баннер {bid}: в black_list")
+        if bid in list_excluded:
+            if log_info:
+                if whitelist_set is not None and bid not in whitelist_set:
+                    log.info("▶ Пропускаем баннер %s: не в white_list", bid)
+                else:
+                    log.info("▶ Пропускаем баннер %s: в black_list", bid)
             continue
         
         # --- spent_all_time <= 5000 rule ---
         if only_spent_all_time_lte_5000:
-            s_all = stats_all_map.get(bid, {}) or {}
-            mv_all = metric_value_from_stats(s_all)
+            s_all = stats_all_map.get(bid) or _EMPTY_STATS
+            mv_all = mv_all_map[bid] = metric_value_from_stats(s_all)
             if mv_all["SPENT"] > 5000.0:
-                logger.info(f"▶ Пропускаем баннер {bid}: spent_all_time={mv_all['SPENT']:.2f} > 5000 (only_spent_all_time_lte_5000=true)")
+                if log_info:
+                    log.info(
+                        "▶ Пропускаем баннер %s: spent_all_time=%.2f > 5000 (only_spent_all_time_lte_5000=true)",
+                        bid, mv_all["SPENT"],
+                    )
                 continue
                 
-        gid = int((api.banner_info_cache.get(bid, {}) or {}).get("ad_group_id") or 0)
-        ta = banner_target_action_from_groups(gid, group_objectives)
         log_banner_stats(
             banner_id=bid,
             periods=periods,
             stats_by_period=stats_by_period,
-            income_store=income_store,
-            target_action=ta,
+            income_by_period=income_by_period,
+            target_action=banner_ta[bid],
+            ctx=ctx,
+            log=log,
         )
         
-        gid = int((api.banner_info_cache.get(bid, {}) or {}).get("ad_group_id") or 0)
-        bobj = {**(active_by_id.get(bid, {}) or {}), "ad_group_id": gid}
-
         state, reason, short_reason = decide_action_for_banner(
-            templates=templates,
-            cabinet_id=cabinet_id,
+            ordered_templates=ordered_templates,
             banner_id=bid,
-            banner_obj=bobj,
             stats_by_period=stats_by_period,
-            income_store=income_store,
-            banner_objectives=group_objectives,
+            income_by_period=income_by_period,
+            banner_ta=banner_ta,
+            ctx=ctx,
         )
 
         if state != "DISABLE":
             continue
 
-        if disabled_count >= effective_max_disables:
-            logger.warning("🚨 Достигнут лимит отключений за запуск — дальнейшие баннеры не будут отключаться")
-            break
+        if len(disabled_ok) + len(to_disable) - sent >= effective_max_disables:
+            send_pending()
+            if len(disabled_ok) >= effective_max_disables:
+                log.warning("🚨 Достигнут лимит отключений за запуск — дальнейшие баннеры не будут отключаться")
+                break
 
-        ok = api.disable_banner(bid)
-        if not ok:
-            continue
+        to_disable.append((bid, reason, short_reason))
+    send_pending()
 
-        disabled_count += 1
+    # локальные имена для циклов записи по баннерам
+    get_name = api.get_banner_name
+    get_url = api.get_banner_url
 
-        name = api.get_banner_name(bid) or "Без названия"
-        url = api.get_banner_url(bid)
-        stats_all_key = json.dumps({"type": "ALL_TIME"}, sort_keys=True, ensure_ascii=False)
-        stats_all = (stats_by_period.get(stats_all_key, {}) or {}).get(bid, {}) or {}
-        income_all = income_store.income_for_period(bid, {"type": "ALL_TIME"})
+    for bid, reason, short_reason in to_disable:
+        if bid not in disabled_ok:
+            continue
+
+        name = get_name(bid) or "Без названия"
+        url = get_url(bid)
+        stats_all = stats_all_map.get(bid) or _EMPTY_STATS
+        income_all = income_all_map.get(bid, 0.0)
         
         rec = make_banner_record(
             bid, name, url, stats_all,
@@ -1804,70 +2769,72 @@ def process_cabinet(
             reason=reason or "Отключено фильтром",
             short_reason=short_reason or "",
             income=income_all,
+            mv=mv_all_map.get(bid),
         )
         
         disabled_records[str(bid)] = rec
         enabled_records.pop(str(bid), None)
-        append_history(his_path, rec)
-
-        mv = metric_value_from_stats(stats_all)
-        income_all = income_store.income_for_period(bid, {"type": "ALL_TIME"})
+        append_history(his_path, rec.to_dict())
 
-    # 2) ENABLE для blocked (только те, что мы отключали)
+    # 2) ENABLE для blocked (только те, что мы отключали) — тоже одной пачкой
+    to_enable: List[Tuple[int, str, str]] = []
     for bid in blocked_ids:
         if str(bid) not in disabled_records:
             continue
             
         # --- whitelist/blacklist ---
-        if whitelist_set is not None and bid not in whitelist_set:
-            logger.info(f"▶ Пропускаем баннер {bid}: не в white_list")
-            continue
-        if bid in blacklist_set:
-            logger.info(f"▶ Пропускаем баннер {bid}: в black_list")
+        if bid in list_excluded:
+            if log_info:
+                if whitelist_set is not None and bid not in whitelist_set:
+                    log.info("▶ Пропускаем баннер %s: не в white_list", bid)
+                else:
+                    log.info("▶ Пропускаем баннер %s: в black_list", bid)
             continue
         
         # --- spent_all_time <= 5000 rule ---
         if only_spent_all_time_lte_5000:
-            s_all = stats_all_map.get(bid, {}) or {}
-            mv_all = metric_value_from_stats(s_all)
+            s_all = stats_all_map.get(bid) or _EMPTY_STATS
+            mv_all = mv_all_map[bid] = metric_value_from_stats(s_all)
             if mv_all["SPENT"] > 5000.0:
-                logger.info(f"▶ Пропускаем баннер {bid}: spent_all_time={mv_all['SPENT']:.2f} > 5000 (only_spent_all_time_lte_5000=true)")
+                if log_info:
+                    log.info(
+                        "▶ Пропускаем баннер %s: spent_all_time=%.2f > 5000 (only_spent_all_time_lte_5000=true)",
+                        bid, mv_all["SPENT"],
+                    )
                 continue
                 
-        gid = int((api.banner_info_cache.get(bid, {}) or {}).get("ad_group_id") or 0)
-        ta = banner_target_action_from_groups(gid, group_objectives)
         log_banner_stats(
             banner_id=bid,
             periods=periods,
             stats_by_period=stats_by_period,
-            income_store=income_store,
-            target_action=ta,
+            income_by_period=income_by_period,
+            target_action=banner_ta[bid],
+            ctx=ctx,
+            log=log,
         )
         
-        gid = int((api.banner_info_cache.get(bid, {}) or {}).get("ad_group_id") or 0)
-        bobj = {**(blocked_by_id.get(bid, {}) or {}), "ad_group_id": gid}
-
         state, reason, short_reason = decide_action_for_banner(
-            templates=templates,
-            cabinet_id=cabinet_id,
+            ordered_templates=ordered_templates,
             banner_id=bid,
-            banner_obj=bobj,
             stats_by_period=stats_by_period,
-            income_store=income_store,
-            banner_objectives=group_objectives,
+            income_by_period=income_by_period,
+            banner_ta=banner_ta,
+            ctx=ctx,
         )
         if state != "ENABLE":
             continue
-        
-        ok = api.enable_banner(bid)
-        if not ok:
+
+        to_enable.append((bid, reason, short_reason))
+
+    enabled_ok = set(api.enable_banners_bulk([bid for bid, _, _ in to_enable]))
+    for bid, reason, short_reason in to_enable:
+        if bid not in enabled_ok:
             continue
-        
-        name = api.get_banner_name(bid) or "Без названия"
-        url = api.get_banner_url(bid)
-        stats_all_key = json.dumps({"type": "ALL_TIME"}, sort_keys=True, ensure_ascii=False)
-        stats_all = (stats_by_period.get(stats_all_key, {}) or {}).get(bid, {}) or {}
-        income_all = income_store.income_for_period(bid, {"type": "ALL_TIME"})
+
+        name = get_name(bid) or "Без названия"
+        url = get_url(bid)
+        stats_all = stats_all_map.get(bid) or _EMPTY_STATS
+        income_all = income_all_map.get(bid, 0.0)
         
         rec = make_banner_record(
             bid, name, url, stats_all,
@@ -1876,6 +2843,7 @@ def process_cabinet(
             reason=reason or "Включено фильтром",
             short_reason=short_reason or "",
             income=income_all,
+            mv=mv_all_map.get(bid),
         )
         
         # переносим между списками
@@ -1883,20 +2851,19 @@ def process_cabinet(
         enabled_records[str(bid)] = rec
         
         # история: только дописываем
-        append_history(his_path, rec)
-        mv = metric_value_from_stats(stats_all)
+        append_history(his_path, rec.to_dict())
         
 
     save_disabled_records(dis_path, disabled_records)
     save_disabled_records(en_path, enabled_records)
     
-    logger.info(f"💾 disabled_banners.json: {dis_path} (records={len(disabled_records)})")
-    logger.info(f"💾 enabled_banners.json:  {en_path} (records={len(enabled_records)})")
-    logger.info(f"🧾 history_banners.json:  {his_path}")
+    log.info(f"💾 disabled_banners.json: {dis_path} (records={len(disabled_records)})")
+    log.info(f"💾 enabled_banners.json:  {en_path} (records={len(enabled_records)})")
+    log.info(f"🧾 history_banners.jsonl: {his_path}")
 
     # --- TG notify (batch by history since last send) ---
     if tg_notify_enabled and tg_bot_token and chat_id:
-        state_path = notify_state_path(users_root, tg_id, cabinet_id)
+        state_path = paths.notify_state
         last_notify_utc = load_last_notify_utc(state_path)
 
         if is_due_to_send(last_notify_utc, tg_notify_every_min):
@@ -1904,43 +2871,45 @@ def process_cabinet(
             events = reduce_latest_per_banner(events)
 
             if events:
-                off = [e for e in events if str(e.get("status")) == "off"]
-                on_ = [e for e in events if str(e.get("status")) == "on"]
+                off: List[Dict[str, Any]] = []
+                on_: List[Dict[str, Any]] = []
+                for e in events:
+                    st = str(e.get("status"))
+                    if st == "off":
+                        off.append(e)
+                    elif st == "on":
+                        on_.append(e)
 
                 parts: List[str] = [f"<b>[{cabinet_name}]</b>"]
 
                 if off:
-                    lines = []
-                    for e in off:
-                        lines.append(
-                            f"<b>{e.get('name_banner','')}</b> #{e.get('id_banner','')}\n"
-                            f"    ⤷ Причина: {e.get('short_reason','')}\n"
-                            f"    ⤷ Потрачено: {e.get('spent_all_time','')} ₽\n"
-                            f"    ⤷ Результат: {e.get('goals_all_time','')} | {e.get('cpa_all_time','')} ₽"
+                    parts.append("<b>Отключены баннеры:</b>\n\n" + "\n\n".join([
+                        _TG_OFF_ITEM % (
+                            e.get("name_banner", ""), e.get("id_banner", ""), e.get("short_reason", ""),
+                            e.get("spent_all_time", ""), e.get("goals_all_time", ""), e.get("cpa_all_time", ""),
                         )
-                    parts.append("<b>Отключены баннеры:</b>\n\n" + "\n\n".join(lines))
+                        for e in off
+                    ]))
 
                 if on_:
-                    lines = []
-                    for e in on_:
-                        lines.append(
-                            f"<b>{e.get('name_banner','')}</b> #{e.get('id_banner','')}\n"
-                            f"    ⤷ Причина: {e.get('short_reason','')}\n"
-                            f"    ⤷ Доход: {e.get('income','')} ₽\n"
-                            f"    ⤷ Потрачено: {e.get('spent_all_time','')} ₽\n"
-                            f"    ⤷ Результат: {e.get('goals_all_time','')} | {e.get('cpa_all_time','')} ₽"
+                    parts.append("<b>Включены баннеры:</b>\n\n" + "\n\n".join([
+                        _TG_ON_ITEM % (
+                            e.get("name_banner", ""), e.get("id_banner", ""), e.get("short_reason", ""),
+                            e.get("income", ""), e.get("spent_all_time", ""), e.get("goals_all_time", ""),
+                            e.get("cpa_all_time", ""),
                         )
-                    parts.append("<b>Включены баннеры:</b>\n\n" + "\n\n".join(lines))
+                        for e in on_
+                    ]))
 
                 tg_notify(tg_bot_token, chat_id, "\n\n".join(parts), dry_run=dry_run)
                 save_last_notify_utc(state_path, dt.datetime.utcnow())
             else:
-                logger.info("🔕 TG: нет новых событий с момента последней отправки")
+                log.info("🔕 TG: нет новых событий с момента последней отправки")
         else:
-            logger.info(f"🔕 TG throttle: уведомления не отправляем (tg_notify_every_min={tg_notify_every_min})")
+            log.info(f"🔕 TG throttle: уведомления не отправляем (tg_notify_every_min={tg_notify_every_min})")
     else:
         if not tg_notify_enabled:
-            logger.info("🔕 TG уведомления отключены (tg_notify_enabled=false)")
+            log.info("🔕 TG уведомления отключены (tg_notify_enabled=false)")
 
 
 # ============================================================
@@ -1980,6 +2949,27 @@ def main() -> None:
         load_user_env(users_root, tg_id)
         try:
             cfg = load_user_config(users_root, tg_id)
+
+            # сначала дешёвые проверки — без фильтров/кабинетов не грузим ни настройки, ни доходы
+            templates = load_user_filters(users_root, tg_id)
+            if not templates:
+                logger.info(f"[USER {tg_id}] Нет активных фильтров — пропуск (ничего делать не будем)")
+                continue
+
+            accounts = cfg.get("accounts") or cfg.get("cabinets") or []
+            if not isinstance(accounts, list) or not accounts:
+                logger.warning(f"[USER {tg_id}] В конфиге нет accounts/cabinets — пропуск")
+                continue
+
+            cabinets = [cab for cab in accounts if isinstance(cab, dict) and cab.get("active") is not False]
+            if not cabinets:
+                continue
+
+            # шаблоны разбираем один раз — общие для всех кабинетов пользователя
+            templates = compile_templates(templates)
+            # периоды зависят только от шаблонов — тоже один раз на пользователя
+            periods = collect_periods_from_filters([tpl.raw for tpl in templates])
+
             settings = load_user_settings(users_root, tg_id)
             ignore_manual_enabled_ads = bool(settings.get("ignore_manual_enabled_ads", False))
 
@@ -1999,24 +2989,9 @@ def main() -> None:
             chat_id = str(tg_id)
 
             income_path = str(cfg.get("income_path") or "").strip()
-            income_store = load_income_store(income_path) if income_path else IncomeStore(total={}, by_day={})
-
-            templates = load_user_filters(users_root, tg_id)
-            if not templates:
-                logger.info(f"[USER {tg_id}] Нет активных фильтров — пропуск (ничего делать не будем)")
-                continue
-
-            accounts = cfg.get("accounts") or cfg.get("cabinets") or []
-            if not isinstance(accounts, list) or not accounts:
-                logger.warning(f"[USER {tg_id}] В конфиге нет accounts/cabinets — пропуск")
-                continue
-
-            for cab in accounts:
-                if not isinstance(cab, dict):
-                    continue
-                if cab.get("active") is False:
-                    continue
+            income_store = load_income_store_cached(income_path) if income_path else IncomeStore(total={}, by_day={})
 
+            def run_cabinet(cab: Dict[str, Any]) -> None:
                 try:
                     process_cabinet(
                         users_root=users_root,
@@ -2024,6 +2999,7 @@ def main() -> None:
                         chat_id=chat_id,
                         tg_bot_token=tg_bot_token,
                         templates=templates,
+                        periods=periods,
                         income_store=income_store,
                         cabinet=cab,
                         dry_run=dry_run,
@@ -2039,9 +3015,15 @@ def main() -> None:
                 except Exception as e:
                     logger.exception(f"[USER {tg_id}] Ошибка обработки кабинета {cab.get('name') or cab.get('id')}: {e}")
 
+            # кабинеты независимы (свои файлы, свой VkAdsApi) — обрабатываем параллельно
+            with ThreadPoolExecutor(max_workers=min(MAX_CABINET_WORKERS, len(cabinets))) as ex:
+                list(ex.map(run_cabinet, cabinets))
+
         except Exception as e:
             logger.exception(f"Ошибка обработки пользователя {tg_id}: {e}")
 
+    # TG-уведомления уходят в фоне — не выходим, пока очередь не отправлена
+    tg_flush()
     logger.info("Готово")
 
 